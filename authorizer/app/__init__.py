@@ -6,9 +6,13 @@ from flask import Flask
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from config import Config
+from app.identity import IdentityCache
+from app.hashing import PasswordHasher
 
 # Initialize extensions
 db = SQLAlchemy()
+identity = IdentityCache()
+hasher = PasswordHasher()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = 'Please log in to access this page.'
@@ -20,6 +24,8 @@ def create_app(config_class=Config):
   # Load extensions on app
   db.init_app(app)
   login.init_app(app)
+  identity.init_app(app, db)
+  hasher.init_app(app)
 
   # Register blueprints
   from app.auth import bp as auth_bp
@@ -16,9 +16,13 @@ def login():
   form = LoginForm()
   if form.validate_on_submit():
     user = User.query.filter_by(username=form.username.data).first()
-    if user is None or user.check_password(form.password.data):
+    if user is None or not user.check_password(form.password.data):
       flash('Invalid username or password.')
       return redirect(url_for('auth.login'))
+    if user.password_needs_rehash():
+      # stored at an older cost; upgrade it while the password is at hand
+      user.set_password(form.password.data)
+      db.session.commit()
     login_user(user, remember=form.remember_me.data)
     return redirect(url_for('main.index'))
   return render_template('auth/login.html', title="Log In", form=form)
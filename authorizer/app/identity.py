@@ -0,0 +1,96 @@
+"""
+Identity cache for the login user loader
+
+Keeps a tuple of the `__identity__` columns of recently loaded users, at most
+IDENTITY_CACHE_SIZE of them for IDENTITY_CACHE_TTL seconds, and rebuilds the
+user from it without a query. Committing changes to a user drops its entry.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+from sqlalchemy.orm import make_transient_to_detached
+from flask import current_app
+
+
+class _Cache(object):
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[1] < monotonic():
+        self.entries.pop(key, None)
+        return None
+      self.entries.move_to_end(key)
+      return entry[0]
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries[key] = (value, monotonic() + self.ttl)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def pop(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+
+class IdentityCache(object):
+  """Flask extension caching snapshots of the users loaded by `login.user_loader`"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+    app.config.setdefault('IDENTITY_CACHE_TTL', 300)
+    app.extensions['identity_cache'] = _Cache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    self.db = db
+    if not getattr(self, '_listening', False):
+      db.event.listen(db.session, 'after_flush', self._after_flush)
+      db.event.listen(db.session, 'after_commit', self._end)
+      db.event.listen(db.session, 'after_rollback', self._end)
+      self._listening = True
+
+  @property
+  def cache(self):
+    return current_app.extensions['identity_cache']
+
+  def load(self, model, id):
+    """`model.query.get(id)`, served from the cache when possible"""
+    session = self.db.session
+    existing = session.identity_map.get(session.identity_key(model, id))
+    if existing is not None:
+      return existing
+    key = (model.__name__, id)
+    snapshot = self.cache.get(key)
+    if snapshot is None:
+      obj = model.query.get(id)
+      if obj is not None:
+        self.cache.set(key, tuple(getattr(obj, field) for field in model.__identity__))
+      return obj
+    obj = model()
+    for field, value in zip(model.__identity__, snapshot):
+      setattr(obj, field, value)
+    make_transient_to_detached(obj)
+    session.add(obj)
+    return obj
+
+  def _after_flush(self, session, flush_context):
+    changed = session.info.setdefault('identity_changed', set())
+    for obj in list(session.dirty) + list(session.deleted):
+      if hasattr(obj, '__identity__'):
+        key = (type(obj).__name__, obj.id)
+        self.cache.pop(key)
+        changed.add(key)
+
+  def _end(self, session):
+    for key in session.info.pop('identity_changed', ()):
+      self.cache.pop(key)
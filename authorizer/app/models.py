@@ -3,11 +3,13 @@ Application Models
 """
 
 from hashlib import md5
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from app import db, login
+from app import db, login, identity, hasher
 
 class User(UserMixin, db.Model):
+  # columns kept by the login identity cache; password_hash is loaded on demand
+  __identity__ = ['id', 'username', 'email']
+
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String(64), index=True, unique=True)
   email = db.Column(db.String(120), index=True, unique=True)
@@ -17,14 +19,17 @@ class User(UserMixin, db.Model):
     return '<User {}>'.format(self.username)
 
   def set_password(self, password):
-    self.password_hash = generate_password_hash(password)
+    self.password_hash = hasher.hash(password)
   
   def check_password(self, password):
-    return check_password_hash(self.password_hash, password)
+    return hasher.verify(self.password_hash, password)
+
+  def password_needs_rehash(self):
+    return hasher.needs_rehash(self.password_hash)
 
 
 
 # Required callback for Flask-Login. Reloads user object stored in session.
 @login.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
\ No newline at end of file
+    return identity.load(User, int(user_id))
\ No newline at end of file
@@ -14,4 +14,25 @@ class Config(object):
   """str: URI for application database."""
 
   SQLALCHEMY_TRACK_MODIFICATIONS = False
-  """bool: setting for modification tracking."""
\ No newline at end of file
+  """bool: setting for modification tracking."""
+
+  IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+  """int: users whose identity snapshot the login loader keeps per process."""
+
+  IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL') or 300)
+  """float: seconds an identity snapshot is trusted before the user is loaded again."""
+
+  PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+  """str: werkzeug hash method for new password hashes."""
+
+  PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or 150000)
+  """int: PBKDF2 rounds for new password hashes. Older hashes are upgraded at login."""
+
+  PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+  """int: salt length for new password hashes."""
+
+  PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1)
+  """int: processes hashing and verifying passwords; 0 hashes on the request thread."""
+
+  PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 32)
+  """int: hash calls allowed to queue or run at once before logins are answered with 503."""
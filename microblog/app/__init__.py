@@ -14,20 +14,42 @@ from logging.handlers import SMTPHandler, RotatingFileHandler
 from flask import Flask, request, current_app
 from flask_babel import Babel, lazy_gettext as _l
 from flask_bootstrap import Bootstrap
-from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_moment import Moment
 from elasticsearch import Elasticsearch
+from app.routing import RoutingSQLAlchemy
+from app.writebehind import LastSeenBuffer
+from app.pubsub import NotificationHub
+from app.search import SearchIndexer, create_backend
+from app.graph import FollowGraph
+from app.identity import IdentityCache
+from app.hashing import PasswordHasher
+from app.email import MailDispatcher
+from app.profiling import RequestProfiler
+from app.pagecache import PageCache
+from app.fragments import FragmentCache
+from app.cards import UserCards
 
 # Create instances for all extensions
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 mail = Mail()
+mailer = MailDispatcher()
 migrate = Migrate()
 moment = Moment()
 babel = Babel()
 bootstrap = Bootstrap()
+last_seen = LastSeenBuffer()
+hub = NotificationHub()
+indexer = SearchIndexer()
+follow_graph = FollowGraph()
+identity = IdentityCache()
+hasher = PasswordHasher()
+profiler = RequestProfiler()
+page_cache = PageCache()
+fragments = FragmentCache()
+cards = UserCards()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
@@ -39,19 +61,32 @@ def create_app(config_class=Config):
   app = Flask(__name__)
 
   # Instantiate Config class from `config` module. Class variables exist on app.config
-  app.config.from_object(Config)
+  app.config.from_object(config_class)
   
   # Add elasticsearch
   app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+  # fall back to the embedded full-text engine without a cluster
+  app.search_backend = create_backend(app)
 
   # Initialize extensions with app instance
   db.init_app(app)
   mail.init_app(app)
+  mailer.init_app(app, mail)
   migrate.init_app(app, db)
   moment.init_app(app)
   babel.init_app(app)
   bootstrap.init_app(app)
   login.init_app(app)
+  last_seen.init_app(app, db)
+  hub.init_app(app)
+  indexer.init_app(app)
+  follow_graph.init_app(app, db)
+  identity.init_app(app, db)
+  hasher.init_app(app)
+  profiler.init_app(app)
+  page_cache.init_app(app, db)
+  fragments.init_app(app, db)
+  cards.init_app(app, db)
 
   # Register Blueprints
   from app.errors import bp as errors_bp
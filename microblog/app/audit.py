@@ -0,0 +1,76 @@
+"""
+Query plan audit
+
+`known_queries` lists the statements behind the app's pages and feeds;
+`explain` asks the database how it would run one of them and `scans` picks
+out the tables it would read end to end: a full scan reads every row, an
+index scan walks a whole index, which is only cheap under a LIMIT. Used by
+`flask db-audit`. Only SQLite, PostgreSQL and MySQL plans are understood;
+`explain` refuses any other database rather than report no scans.
+"""
+
+import re
+from flask import current_app
+from app import db
+from app.models import User, Post, Message, Notification, followers
+
+# SQLite: "SCAN post" (or "SCAN TABLE post" before 3.36); PostgreSQL: "Seq Scan on post"
+FULL_SCAN = re.compile(r'^(?:SCAN (?:TABLE )?(\w+)(?: AS \w+)?$|.*Seq Scan on (\w+))')
+# SQLite: "SCAN post USING INDEX ix_post_timestamp"
+INDEX_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)? USING (?:COVERING )?INDEX')
+# MySQL, one row of its tabular EXPLAIN as "column=value" pairs: type ALL reads every row, index the whole index
+MYSQL_SCAN = re.compile(r'\btable=(\S+) .*\btype=(ALL|index)\b')
+MYSQL_SCANS = {'ALL': 'full scan', 'index': 'index scan'}
+
+
+def known_queries(user):
+  """`(name, query)` pairs for the hot queries, as run for `user`"""
+  per_page = current_app.config['POSTS_PER_PAGE']
+  newest = lambda query, model: query.order_by(model.timestamp.desc(), model.id.desc()).limit(per_page)
+  return [
+    ('user by username', User.query.filter_by(username=user.username)),
+    ('home timeline', user.timeline().limit(per_page)),
+    ('followed posts', user.followed_posts().limit(per_page)),
+    ('user posts', newest(user.posts, Post)),
+    ('explore', newest(Post.query, Post)),
+    ('messages received', newest(user.messages_received, Message)),
+    ('notifications since', Notification.since_query(user.id, 0)),
+    ('notification by name', user.notifications.filter_by(name='unread_message_count')),
+    ('followed ids', db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user.id)),
+    ('follower ids', db.session.query(followers.c.follower_id).filter(followers.c.followed_id == user.id)),
+  ]
+
+
+def explain(query):
+  """The plan the database reports for `query`, one line per step"""
+  engine = db.session.get_bind()
+  compiled = query.statement.compile(dialect=engine.dialect)
+  if compiled.positional:
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+  else:
+    params = compiled.params
+  if engine.dialect.name == 'sqlite':
+    rows = db.session.connection().execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in rows]
+  if engine.dialect.name not in ('postgresql', 'mysql'):
+    raise ValueError('cannot read {} query plans'.format(engine.dialect.name))
+  rows = db.session.connection().execute('EXPLAIN ' + str(compiled), params)
+  if engine.dialect.name == 'mysql':
+    return [' '.join('{}={}'.format(name, value) for name, value in row.items()) for row in rows]
+  return [row[0] for row in rows]
+
+
+def scans(plan):
+  """`(kind, table)` for every table `plan` reads end to end, kind being 'full scan' or 'index scan'"""
+  found = []
+  for line in plan:
+    line = line.strip()
+    match = FULL_SCAN.match(line)
+    if match:
+      found.append(('full scan', match.group(1) or match.group(2)))
+    elif INDEX_SCAN.match(line):
+      found.append(('index scan', INDEX_SCAN.match(line).group(1)))
+    elif MYSQL_SCAN.search(line):
+      match = MYSQL_SCAN.search(line)
+      found.append((MYSQL_SCANS[match.group(2)], match.group(1)))
+  return found
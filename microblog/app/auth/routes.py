@@ -26,6 +26,10 @@ def login():
     if user is None or not user.check_password(form.password.data):
       flash(_('Invalid username or password.'))
       return redirect(url_for('auth.login'))
+    if user.password_needs_rehash():
+      # the hash predates the configured cost; upgrade it while the password is at hand
+      user.set_password(form.password.data)
+      db.session.commit()
     # sets current_user once logged in
     login_user(user, remember=form.remember_me.data)
     next_page = request.args.get('next')
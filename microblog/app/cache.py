@@ -0,0 +1,75 @@
+"""
+In-process caches
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache(object):
+  """Thread-safe mapping that evicts the least recently used entries.
+
+  The cache holds at most `capacity` units of weight; by default every entry
+  weighs 1, pass `weigh(value)` to bound it by size instead. Entries older
+  than `ttl` seconds are treated as missing. Hits, misses and evictions are
+  counted in `stats()`.
+  """
+
+  def __init__(self, capacity, ttl=None, weigh=None):
+    self.capacity = capacity
+    self.ttl = ttl
+    self.weigh = weigh or (lambda value: 1)
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.weight = 0
+    self.hits = self.misses = self.evictions = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and self.ttl is not None and entry[2] < monotonic():
+        self._remove(key)
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return default
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def set(self, key, value):
+    weight = self.weigh(value)
+    expires = monotonic() + self.ttl if self.ttl is not None else None
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      if weight > self.capacity:
+        return
+      self.entries[key] = (value, weight, expires)
+      self.weight += weight
+      while self.weight > self.capacity:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+
+  def pop(self, key):
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.weight = 0
+
+  def stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+        'entries': len(self.entries), 'weight': self.weight}
+
+  def __len__(self):
+    return len(self.entries)
+
+  def _remove(self, key):
+    value, weight, expires = self.entries.pop(key)
+    self.weight -= weight
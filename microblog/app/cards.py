@@ -0,0 +1,80 @@
+"""
+User cards
+
+Compact JSON summaries of users for the hover popups. `UserCards.get` returns
+the cards for a batch of usernames, loading the ones not in the cache with a
+single query. Cards hold nothing specific to the viewer; whether the viewer
+follows a user is added per request from the follow-graph cache. Cached cards
+live for at most CARD_CACHE_TTL seconds, and flushing a change to a user (a
+new follower included, through the counters) drops their card.
+"""
+
+from flask import current_app, url_for
+from sqlalchemy import inspect
+from app.cache import LRUCache
+
+
+def card(user):
+  return {
+    'id': user.id,
+    'username': user.username,
+    'url': url_for('main.user', username=user.username),
+    'avatar': user.avatar(64),
+    'about_me': user.about_me,
+    'last_seen': user.last_seen.isoformat() + 'Z' if user.last_seen else None,
+    'followers': user.followers_count,
+    'following': user.followed_count,
+    'follow_url': url_for('main.follow', username=user.username),
+    'unfollow_url': url_for('main.unfollow', username=user.username),
+  }
+
+
+class UserCards(object):
+  """Flask extension caching the user cards served to the popups"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('CARD_CACHE_SIZE', 10000)
+    app.config.setdefault('CARD_CACHE_TTL', 60)
+    app.config.setdefault('CARDS_MAX_BATCH', 100)
+    app.extensions['user_cards'] = LRUCache(app.config['CARD_CACHE_SIZE'], ttl=app.config['CARD_CACHE_TTL'])
+    self.db = db
+    if not getattr(self, '_listening', False):
+      db.event.listen(db.session, 'after_flush', self._after_flush)
+      self._listening = True
+
+  @property
+  def cache(self):
+    return current_app.extensions['user_cards']
+
+  def get(self, usernames):
+    """`{username: card}` for those of `usernames` that exist"""
+    from app.models import User
+    cache = self.cache
+    cards, missing = {}, []
+    for username in usernames:
+      cached = cache.get(username)
+      if cached is None:
+        missing.append(username)
+      else:
+        cards[username] = cached
+    if missing:
+      # cached past this request, so never from a lagging replica
+      with self.db.primary():
+        users = User.query.filter(User.username.in_(missing)).all()
+      for user in users:
+        cards[user.username] = card(user)
+        if current_app.config['CARD_CACHE_SIZE']:
+          cache.set(user.username, cards[user.username])
+    return cards
+
+  def _after_flush(self, session, flush_context):
+    from app.models import User
+    for obj in list(session.dirty) + list(session.deleted):
+      if isinstance(obj, User):
+        # a rename leaves the card under the old name too
+        for username in inspect(obj).attrs.username.history.sum():
+          self.cache.pop(username)
@@ -30,4 +30,178 @@ def register(app):
       raise RuntimeError('extract command failed')
     if os.system('pybabel init -i messages.pot -d app/translations -l ' + lang):
       raise RuntimeError('init command failed')
-    os.remove('messages.pot')
\ No newline at end of file
+    os.remove('messages.pot')
+
+  @app.cli.group()
+  def search():
+    """Search index commands"""
+    pass
+
+  @search.command()
+  @click.option('--chunk-size', default=1000, help='Rows read and sent per bulk request.')
+  @click.option('--workers', default=4, help='Parallel bulk requests.')
+  @click.option('--checkpoint', default=None, help='Progress file. Defaults to .reindex-<index>.json')
+  @click.option('--restart', is_flag=True, help='Ignore any saved progress and start from the first row.')
+  def reindex(chunk_size, workers, checkpoint, restart):
+    """Rebuild the search index, resuming an interrupted run."""
+    from flask import current_app
+    from app.models import SearchableMixin
+    if not current_app.search_backend:
+      raise click.ClickException('no search backend configured')
+
+    def report(stats):
+      click.echo('\r{index}: {indexed} documents up to id {last_id} ({rate:.0f} docs/s)'.format(**stats), nl=False)
+
+    for model in SearchableMixin.__subclasses__():
+      path = checkpoint or '.reindex-{}.json'.format(model.__tablename__)
+      if restart and os.path.exists(path):
+        os.remove(path)
+      stats = model.reindex(chunk_size=chunk_size, workers=workers, checkpoint=path, report=report)
+      if stats['resumed_from']:
+        click.echo('\n{index}: resumed after id {resumed_from}'.format(**stats), nl=False)
+      click.echo('\n{index}: {indexed} documents in {seconds:.1f}s, {failed} failed'.format(**stats))
+
+
+  @app.cli.group()
+  def counters():
+    """Denormalized counter commands"""
+    pass
+
+  @counters.command()
+  @click.option('--dry-run', is_flag=True, help='Only report users whose counters have drifted.')
+  def reconcile(dry_run):
+    """Recompute follower, following, post and unread message counters that have drifted."""
+    from app import db
+    from app.models import User
+    drifted = User.reconcile_counters()
+    if dry_run:
+      db.session.rollback()
+    else:
+      db.session.commit()
+    click.echo('{} users {}'.format(len(drifted), 'have drifted' if dry_run else 'reconciled'))
+
+  @app.cli.group()
+  def notifications():
+    """Notification maintenance commands"""
+    pass
+
+  @notifications.command()
+  @click.option('--days', type=float, help='Keep notifications updated within this many days (default: NOTIFICATIONS_RETENTION_DAYS).')
+  @click.option('--batch-size', default=1000, help='Rows deleted per transaction.')
+  def prune(days, batch_size):
+    """Delete notifications past the retention period."""
+    from time import time
+    from app.models import Notification
+    days = days if days is not None else app.config['NOTIFICATIONS_RETENTION_DAYS']
+    deleted = Notification.prune(time() - days * 86400, batch_size)
+    click.echo('{} notifications pruned'.format(deleted))
+
+  @app.cli.command()
+  @click.option('--users', default=1000, type=click.IntRange(1), help='Users to create.')
+  @click.option('--posts', default=10000, help='Posts to create.')
+  @click.option('--messages', default=2000, help='Private messages to create.')
+  @click.option('--follows', default=20.0, help='Mean number of accounts each user follows.')
+  @click.option('--days', default=30.0, help='Spread post and message timestamps over this many past days.')
+  @click.option('--seed', type=int, help='Random seed, for a reproducible dataset.')
+  def generate(users, posts, messages, follows, days, seed):
+    """Bulk-insert a synthetic dataset with a power-law follow graph."""
+    from time import time
+    from app.synthetic import generate
+    started = time()
+    report = lambda stage, count: click.echo('{:>10} {:<9} {:6.1f}s'.format(count, stage, time() - started))
+    generate(users, posts, messages, follows=follows, days=days, seed=seed, report=report)
+    click.echo('Every user\'s password is "password". Run `flask search reindex` to index the posts.')
+
+  @app.cli.command('import')
+  @click.option('--users', type=click.Path(exists=True, dir_okay=False), help='Users file (.jsonl or .csv, optionally .gz).')
+  @click.option('--follows', type=click.Path(exists=True, dir_okay=False), help='Follow edges file.')
+  @click.option('--posts', type=click.Path(exists=True, dir_okay=False), help='Posts file.')
+  @click.option('--messages', type=click.Path(exists=True, dir_okay=False), help='Private messages file.')
+  @click.option('--batch-size', default=10000, type=click.IntRange(1), help='Rows inserted per transaction.')
+  @click.option('--hash-workers', type=click.IntRange(0), help='Processes hashing passwords (default: one per CPU, 0 hashes inline).')
+  @click.option('--hash-iterations', type=click.IntRange(1), help='Hash iterations for imported passwords, raised at first login (default: PASSWORD_HASH_ITERATIONS).')
+  @click.option('--checkpoint', default='.import.json', help='Progress file.')
+  @click.option('--restart', is_flag=True, help='Ignore any saved progress and start from the first row.')
+  @click.option('--no-reindex', is_flag=True, help='Leave the search index for a later `flask search reindex`.')
+  def import_(users, follows, posts, messages, batch_size, hash_workers, hash_iterations, checkpoint, restart, no_reindex):
+    """Bulk-load users, follows, posts and messages, resuming an interrupted run."""
+    from time import time
+    from app.importer import Importer, BadRecord
+    files = {kind: path for kind, path in (('users', users), ('follows', follows), ('posts', posts),
+                                           ('messages', messages)) if path}
+    if not files:
+      raise click.ClickException('nothing to import')
+    if restart and os.path.exists(checkpoint):
+      os.remove(checkpoint)
+    started = time()
+    report = lambda kind, done, skipped, rate: click.echo(
+      '\r{:>10} {:<9} {} skipped ({:.0f} rows/s)'.format(done, kind, skipped, rate), nl=False)
+    importer = Importer(checkpoint, batch_size=batch_size, hash_workers=hash_workers,
+                        hash_iterations=hash_iterations, report=report)
+    try:
+      state = importer.run(files, reindex=not no_reindex)
+    except BadRecord as e:
+      raise click.ClickException('{}\nFix the record and run the same command again to resume.'.format(e))
+    except ValueError as e:
+      raise click.ClickException('{} (use --restart to start over)'.format(e))
+    click.echo()
+    for kind, progress in state['files'].items():
+      click.echo('{:>10} {:<9} {} skipped'.format(progress['done'] - progress['skipped'], kind, progress['skipped']))
+    if state['taken']:
+      click.echo('usernames already taken, their rows skipped: ' + ', '.join(state['taken'][:20]) +
+                 (' and {} more'.format(len(state['taken']) - 20) if len(state['taken']) > 20 else ''))
+    click.echo('done in {:.1f}s'.format(time() - started))
+
+  @app.cli.command()
+  @click.argument('username')
+  @click.option('--output', '-o', type=click.File('wb'), default='-', help='File to write (default: standard output).')
+  @click.option('--gzip', 'gzipped', is_flag=True, help='gzip the output as it streams.')
+  @click.option('--cursor', help='Resume after the line carrying this cursor.')
+  def export(username, output, gzipped, cursor):
+    """Stream a user's profile, posts, messages and follows as NDJSON."""
+    from app.export import export_records, parse_cursor, chunked, compress
+    from app.models import User
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+      raise click.ClickException('no user named {}'.format(username))
+    if cursor:
+      try:
+        parse_cursor(cursor)
+      except ValueError as e:
+        raise click.ClickException(str(e))
+    chunks = chunked(export_records(user, cursor), app.config['EXPORT_CHUNK_SIZE'])
+    for chunk in compress(chunks) if gzipped else (chunk.encode('utf-8') for chunk in chunks):
+      output.write(chunk)
+      output.flush()
+
+  @app.cli.command('db-audit')
+  @click.option('--user', 'username', help='Run the per-user queries as this user (default: the first one).')
+  @click.option('--strict', is_flag=True, help='Exit with status 1 if any query scans a full table.')
+  def db_audit(username, strict):
+    """EXPLAIN the app's hot queries and flag full table scans."""
+    from app import db
+    from app.audit import known_queries, explain, scans
+    from app.models import User
+    user = User.query.filter_by(username=username).first() if username else User.query.order_by(User.id).first()
+    if user is None:
+      # an empty database still has plans; stand in a user that is never written
+      from sqlalchemy.orm import make_transient_to_detached
+      user = User(id=0, username='')
+      make_transient_to_detached(user)
+      db.session.add(user)
+    full = 0
+    for name, query in known_queries(user):
+      try:
+        plan = explain(query)
+      except ValueError as e:
+        raise click.ClickException(str(e))
+      found = scans(plan)
+      full += any(kind == 'full scan' for kind, table in found)
+      click.echo(name)
+      for line in plan:
+        click.echo('    ' + line)
+      for kind, table in found:
+        click.secho('  ! {} on {}'.format(kind, table), fg='red' if kind == 'full scan' else 'yellow')
+    click.echo('{} queries scan a full table'.format(full))
+    if strict and full:
+      raise SystemExit(1)
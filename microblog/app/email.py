@@ -1,16 +1,182 @@
+"""
+Outbound mail
+
+Messages are handed to `MailDispatcher`, which holds them in a queue of at
+most MAIL_QUEUE_SIZE and sends them from MAIL_WORKERS background threads.
+Each worker takes up to MAIL_BATCH_SIZE queued messages at a time and sends
+them over one SMTP connection. Connection failures are retried with
+exponential backoff; a message the server rejects outright (a 5xx reply), or
+one still failing after MAIL_MAX_RETRIES, is logged and dropped on its own and
+the rest of the batch goes on. When the queue is full,
+senders wait up to MAIL_QUEUE_TIMEOUT seconds and then get `MailQueueFull`.
+Queued mail is drained when the process exits, or when `close` is called for
+an app that is going away. Workers only hold their app's state weakly, so an
+app dropped without `close` takes its workers with it.
+
+To watch the mail locally, run a debugging server and point MAIL_SERVER and
+MAIL_PORT at it:
+
+  python -m smtpd -n -c DebuggingServer localhost:8025
+"""
+
+import atexit
+import queue
+import smtplib
+import threading
+import weakref
+from time import monotonic
 from flask import current_app
 from flask_mail import Message
-from threading import Thread
-from app import mail
+from werkzeug.exceptions import ServiceUnavailable
+
+
+def retriable(e):
+  """Whether `e` is a connection problem or a temporary (4xx) refusal, rather than a rejected message"""
+  if isinstance(e, smtplib.SMTPResponseException):
+    return 400 <= e.smtp_code < 500
+  if isinstance(e, smtplib.SMTPRecipientsRefused):
+    return all(400 <= code < 500 for code, message in e.recipients.values())
+  if isinstance(e, smtplib.SMTPServerDisconnected):
+    return True
+  # SMTPException is an OSError too, but only the socket errors are worth a retry
+  return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+
+class MailQueueFull(ServiceUnavailable):
+  description = 'Too much mail is waiting to be sent, please try again in a moment.'
+
+
+class _DispatcherState(object):
+  def __init__(self, dispatcher, app, mail):
+    self.dispatcher = dispatcher
+    self.app = app
+    self.mail = mail
+    self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+    self.lock = threading.Lock()
+    self.threads = []
+    self.stopped = threading.Event()
+
+
+class MailDispatcher(object):
+  """Flask extension sending mail from a bounded pool of batching workers"""
+
+  def __init__(self, app=None, mail=None):
+    self._states = weakref.WeakSet()
+    atexit.register(self.shutdown)
+    if app is not None:
+      self.init_app(app, mail)
+
+  def init_app(self, app, mail):
+    app.config.setdefault('MAIL_WORKERS', 2)
+    app.config.setdefault('MAIL_QUEUE_SIZE', 1000)
+    app.config.setdefault('MAIL_QUEUE_TIMEOUT', 5)
+    app.config.setdefault('MAIL_BATCH_SIZE', 50)
+    app.config.setdefault('MAIL_MAX_RETRIES', 5)
+    app.config.setdefault('MAIL_RETRY_BACKOFF', 1)
+    app.config.setdefault('MAIL_SHUTDOWN_TIMEOUT', 10)
+    state = _DispatcherState(self, app, mail)
+    app.extensions['mail_dispatcher'] = state
+    self._states.add(state)
+
+  def send(self, msg):
+    """Queue `msg`, waiting for room up to MAIL_QUEUE_TIMEOUT seconds"""
+    state = current_app.extensions['mail_dispatcher']
+    try:
+      state.queue.put(msg, timeout=state.app.config['MAIL_QUEUE_TIMEOUT'])
+    except queue.Full:
+      state.app.logger.error('Mail queue full, refusing message to %s', ', '.join(msg.recipients))
+      raise MailQueueFull()
+    with state.lock:
+      if not state.threads and not state.stopped.is_set():
+        for i in range(state.app.config['MAIL_WORKERS']):
+          thread = threading.Thread(target=self._run, name='mail-{}'.format(i), daemon=True,
+            args=(weakref.ref(state), state.queue, state.stopped, state.app.config['MAIL_BATCH_SIZE']))
+          thread.start()
+          state.threads.append(thread)
+        weakref.finalize(state, state.stopped.set)
+
+  def join(self):
+    """Block until every queued message has been sent or dropped"""
+    current_app.extensions['mail_dispatcher'].queue.join()
+
+  def close(self):
+    """Send what the current app has queued and stop its workers"""
+    state = current_app.extensions['mail_dispatcher']
+    self._stop(state)
+    self._states.discard(state)
+
+  def shutdown(self):
+    for state in list(self._states):
+      self._stop(state)
+
+  def _stop(self, state):
+    state.stopped.set()
+    deadline = monotonic() + state.app.config['MAIL_SHUTDOWN_TIMEOUT']
+    for thread in state.threads:
+      thread.join(max(deadline - monotonic(), 0))
+
+  def _run(self, ref, messages, stopped, batch_size):
+    while True:
+      try:
+        batch = [messages.get(timeout=0.5)]
+      except queue.Empty:
+        # keep going until the queue is drained, even once stopped
+        if stopped.is_set() or ref() is None:
+          return
+        continue
+      while len(batch) < batch_size:
+        try:
+          batch.append(messages.get_nowait())
+        except queue.Empty:
+          break
+      state = ref()
+      try:
+        if state is not None:
+          with state.app.app_context():
+            self._send(state, batch)
+      except Exception:
+        state.app.logger.exception('Mail worker failed on a batch of %d messages', len(batch))
+      finally:
+        for _ in batch:
+          messages.task_done()
+        del state
+
+  def _send(self, state, batch):
+    config = state.app.config
+    pending, attempt = list(batch), 0
+    while pending:
+      sending = None
+      try:
+        with state.mail.connect() as conn:
+          while pending:
+            sending = pending[0]
+            try:
+              conn.send(sending)
+            except smtplib.SMTPException as e:
+              if retriable(e):
+                raise
+              state.app.logger.error('Mail to %s rejected: %r', ', '.join(sending.recipients), e)
+            pending.pop(0)
+            attempt = 0
+      except Exception as e:
+        if not retriable(e):
+          raise
+        if attempt >= config['MAIL_MAX_RETRIES']:
+          if sending is None:
+            state.app.logger.error('Dropping %d messages after %d attempts: %r', len(pending), attempt + 1, e)
+            return
+          # the server took the connection but keeps deferring this one message
+          state.app.logger.error('Dropping mail to %s after %d attempts: %r', ', '.join(sending.recipients), attempt + 1, e)
+          pending.remove(sending)
+          attempt = 0
+          continue
+        # wait, but let shutdown cut the backoff short
+        state.stopped.wait(config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+        attempt += 1
 
-def send_async_email(app, msg):
-  with app.app_context():
-    mail.send(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    # start new thread for sending emails asynchronously
-    Thread(target=send_async_email, args=(current_app, msg)).start()
-
+    current_app.extensions['mail_dispatcher'].dispatcher.send(msg)
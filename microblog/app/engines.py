@@ -0,0 +1,64 @@
+"""
+Engine tuning
+
+`pool_options` fills in the connection pool settings from DATABASE_POOL_SIZE,
+DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE and DATABASE_POOL_PRE_PING.
+SQLite files get a pool too, rather than a new connection on every checkout,
+so the per-connection page cache and memory map outlive a request.
+
+`sqlite_pragmas` runs as each SQLite connection is opened. WAL journaling
+lets readers carry on while a write commits, where the default rollback
+journal locks them out; with it, `synchronous=NORMAL` is still safe against
+corruption and only risks the last commits on power loss. SQLITE_MMAP_SIZE,
+SQLITE_CACHE_SIZE and SQLITE_BUSY_TIMEOUT size the memory map, the page cache
+and how long a connection waits for a lock. Empty settings leave SQLite's own
+defaults.
+"""
+
+from sqlalchemy.pool import QueuePool
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+
+def pool_options(config, sa_url, options):
+  """Add the pool settings for `sa_url` to the `create_engine` `options`"""
+  if config['DATABASE_POOL_PRE_PING']:
+    options.setdefault('pool_pre_ping', True)
+  if config['DATABASE_POOL_RECYCLE'] is not None:
+    options.setdefault('pool_recycle', config['DATABASE_POOL_RECYCLE'])
+  if sa_url.drivername.startswith('sqlite'):
+    if sa_url.database in (None, '', ':memory:') or not config['DATABASE_POOL_SIZE']:
+      return
+    options['poolclass'] = QueuePool
+    # pooled connections move between threads, one at a time
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+  options.setdefault('pool_size', config['DATABASE_POOL_SIZE'])
+  options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+
+
+def sqlite_pragmas(config):
+  """`connect` event listener applying the SQLITE_* settings"""
+  pragmas = []
+  if config['SQLITE_JOURNAL_MODE']:
+    pragmas.append('journal_mode={}'.format(_choice(config['SQLITE_JOURNAL_MODE'], JOURNAL_MODES)))
+  if config['SQLITE_SYNCHRONOUS']:
+    pragmas.append('synchronous={}'.format(_choice(config['SQLITE_SYNCHRONOUS'], SYNCHRONOUS)))
+  for pragma, key in (('mmap_size', 'SQLITE_MMAP_SIZE'), ('cache_size', 'SQLITE_CACHE_SIZE'),
+                      ('busy_timeout', 'SQLITE_BUSY_TIMEOUT')):
+    if config[key] is not None:
+      pragmas.append('{}={:d}'.format(pragma, int(config[key])))
+
+  def connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+      cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
+  return connect
+
+
+def _choice(value, allowed):
+  value = value.lower()
+  if value not in allowed:
+    raise ValueError('{!r} is not one of {}'.format(value, ', '.join(allowed)))
+  return value
@@ -0,0 +1,107 @@
+"""
+Account export
+
+`export_records` streams everything about one user as NDJSON lines: their
+profile, posts, sent and received messages, and who they follow and who
+follows them, in that order. Each section is a single query read through a
+server-side cursor `EXPORT_BATCH_SIZE` rows at a time (`yield_per`), and rows
+are plain column tuples rather than ORM objects, so memory stays flat however
+large the account and the first bytes go out as soon as the first batch is in.
+
+Every line carries a `cursor` token for the position just after it. Passing
+the token of the last line received starts the export again from there, so a
+download that broke off can be resumed instead of restarted.
+
+`compress` gzips the chunks as they stream, flushing after each one so the
+client is never kept waiting on the compressor.
+"""
+
+import json
+import zlib
+from flask import current_app
+from app import db
+from app.models import User, Post, Message, followers
+from app.pagination import encode_cursor, decode_cursor
+
+SECTIONS = ('profile', 'post', 'message_sent', 'message_received', 'following', 'follower')
+
+
+def _time(value):
+  return value.isoformat() + 'Z' if value else None
+
+
+def _posts(user):
+  query = db.session.query(Post.id, Post.body, Post.timestamp).filter(Post.user_id == user.id)
+  return Post.id, query, lambda row: {'id': row.id, 'body': row.body, 'timestamp': _time(row.timestamp)}
+
+
+def _messages(user, own, other, field):
+  query = db.session.query(Message.id, User.username, Message.body, Message.timestamp).join(
+    User, User.id == other).filter(own == user.id)
+  return Message.id, query, lambda row: {
+    'id': row.id, field: row.username, 'body': row.body, 'timestamp': _time(row.timestamp)}
+
+
+def _follows(user, own, other):
+  query = db.session.query(User.id, User.username).join(followers, User.id == other).filter(own == user.id)
+  return User.id, query, lambda row: {'username': row.username}
+
+
+def _sections(user):
+  yield _posts(user)
+  yield _messages(user, Message.sender_id, Message.recipient_id, 'recipient')
+  yield _messages(user, Message.recipient_id, Message.sender_id, 'sender')
+  yield _follows(user, followers.c.follower_id, followers.c.followed_id)
+  yield _follows(user, followers.c.followed_id, followers.c.follower_id)
+
+
+def parse_cursor(token):
+  """`(section, last_id)` from an export cursor. Raises ValueError for malformed tokens."""
+  values, direction = decode_cursor(token)
+  if (direction != 'n' or len(values) != 2 or not all(type(value) is int for value in values) or
+      not 0 <= values[0] < len(SECTIONS)):
+    raise ValueError('invalid cursor')
+  return values
+
+
+def export_records(user, cursor=None):
+  """NDJSON lines for `user`, starting after `cursor` if given"""
+  section, after = parse_cursor(cursor) if cursor else (-1, 0)
+  line = lambda index, key, record: json.dumps(dict(
+    record, type=SECTIONS[index], cursor=encode_cursor([index, key], 'n')), separators=(',', ':')) + '\n'
+  if section < 0:
+    yield line(0, 0, {
+      'username': user.username, 'email': user.email, 'about_me': user.about_me,
+      'last_seen': _time(user.last_seen)})
+  batch_size = current_app.config['EXPORT_BATCH_SIZE']
+  for index, (key, query, record) in enumerate(_sections(user), 1):
+    if index < section:
+      continue
+    if index == section:
+      query = query.filter(key > after)
+    # keyset order, so a cursor names a position that stays put as rows are added
+    for row in query.order_by(key).yield_per(batch_size):
+      yield line(index, row[0], record(row))
+
+
+def chunked(lines, size):
+  """Join `lines` into strings of about `size` characters"""
+  chunk, length = [], 0
+  for line in lines:
+    chunk.append(line)
+    length += len(line)
+    if length >= size:
+      yield ''.join(chunk)
+      chunk, length = [], 0
+  if chunk:
+    yield ''.join(chunk)
+
+
+def compress(chunks):
+  """gzip `chunks` into a stream of bytes, flushing each one through"""
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  for chunk in chunks:
+    data = compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if data:
+      yield data
+  yield compressor.flush()
@@ -0,0 +1,64 @@
+"""
+Rendered fragment cache
+
+`render_post(post)` in a template renders `post.html` for one post, or returns
+the copy rendered earlier for the same post and locale. Entries are kept per
+post with the author version they were rendered against, the author's
+username and email (which the avatar comes from), so renaming an author
+invalidates their posts on the next read. Flushing a change to a post drops
+its entry. Memory is bounded to FRAGMENT_CACHE_SIZE bytes of HTML, least
+recently used posts first out.
+"""
+
+from flask import current_app, g, render_template
+from markupsafe import Markup
+from app.cache import LRUCache
+
+
+def _weigh(entry):
+  version, rendered = entry
+  return sum(len(html) for html in rendered.values())
+
+
+class FragmentCache(object):
+  """Flask extension caching the rendered `post.html` of each post"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 16 * 1024 * 1024)
+    app.extensions['fragment_cache'] = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], weigh=_weigh)
+    app.add_template_global(self.render_post)
+    if not getattr(self, '_listening', False):
+      db.event.listen(db.session, 'after_flush', self._after_flush)
+      self._listening = True
+
+  @property
+  def cache(self):
+    return current_app.extensions['fragment_cache']
+
+  def render_post(self, post):
+    """The rendered `post.html` for `post`, in the current locale"""
+    cache = self.cache
+    version = (post.author.username, post.author.email)
+    locale = g.get('locale')
+    entry = cache.get(post.id)
+    if entry is not None and entry[0] == version and locale in entry[1]:
+      return Markup(entry[1][locale])
+    html = render_template('post.html', post=post)
+    if current_app.config['FRAGMENT_CACHE_SIZE']:
+      rendered = dict(entry[1]) if entry is not None and entry[0] == version else {}
+      rendered[locale] = html
+      cache.set(post.id, (version, rendered))
+    return Markup(html)
+
+  def stats(self):
+    return self.cache.stats()
+
+  def _after_flush(self, session, flush_context):
+    from app.models import Post
+    for obj in list(session.dirty) + list(session.deleted):
+      if isinstance(obj, Post):
+        self.cache.pop(obj.id)
@@ -0,0 +1,109 @@
+"""
+Follow-graph cache
+
+Keeps, per process, the sorted ids each user follows so `is_following` is a
+binary search instead of a query. Ids are stored as compact `array`s and the
+cache is bounded by FOLLOW_GRAPH_CACHE_SIZE ids in total, least recently used
+users first out. Entries are invalidated from engine events whenever a
+statement writes to the `followers` table, and again when that transaction
+commits or rolls back. Those events only reach this process, so entries also
+expire after FOLLOW_GRAPH_CACHE_TTL seconds to catch up with follows made by
+other workers. Until then an answer may be stale, so the cache only serves
+reads; `User.follow` and `User.unfollow` check the edge in the database.
+"""
+
+from array import array
+from bisect import bisect_left
+from sqlalchemy.sql.expression import Insert, Update, Delete
+from flask import current_app
+from app.cache import LRUCache
+
+_ALL = object()
+
+
+def _param_dicts(multiparams, params):
+  for param in multiparams:
+    if isinstance(param, dict):
+      yield param
+    elif isinstance(param, (list, tuple)):
+      for p in param:
+        if isinstance(p, dict):
+          yield p
+  if params:
+    yield params
+
+
+class FollowGraph(object):
+  """Flask extension caching the followed ids of each user"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('FOLLOW_GRAPH_CACHE_SIZE', 1000000)
+    app.config.setdefault('FOLLOW_GRAPH_CACHE_TTL', 60)
+    app.config.setdefault('FOLLOW_GRAPH_INLINE_LIMIT', 500)
+    cache = LRUCache(app.config['FOLLOW_GRAPH_CACHE_SIZE'], ttl=app.config['FOLLOW_GRAPH_CACHE_TTL'],
+                     weigh=lambda ids: len(ids) + 1)
+    app.extensions['follow_graph'] = cache
+    self.db = db
+    with app.app_context():
+      engine = db.engine
+    db.event.listen(engine, 'after_execute', lambda *args: self._after_execute(cache, *args))
+    db.event.listen(engine, 'commit', lambda conn: self._end(cache, conn))
+    db.event.listen(engine, 'rollback', lambda conn: self._end(cache, conn))
+
+  @property
+  def cache(self):
+    return current_app.extensions['follow_graph']
+
+  def followed_ids(self, user_id):
+    """Sorted array of the ids `user_id` follows"""
+    cache = self.cache
+    ids = cache.get(user_id)
+    if ids is None:
+      from app.models import followers
+      # cached past this request, so never from a lagging replica
+      with self.db.primary():
+        rows = self.db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id).all()
+      ids = array('q', sorted(id for id, in rows))
+      cache.set(user_id, ids)
+    return ids
+
+  def is_following(self, user_id, other_id):
+    ids = self.followed_ids(user_id)
+    i = bisect_left(ids, other_id)
+    return i < len(ids) and ids[i] == other_id
+
+  def invalidate(self, user_id):
+    self.cache.pop(user_id)
+
+  def _after_execute(self, cache, conn, clauseelement, multiparams, params, result):
+    if not isinstance(clauseelement, (Insert, Update, Delete)) or clauseelement.table.name != 'followers':
+      return
+    dirty = set()
+    for p in list(_param_dicts(multiparams, params)) or [clauseelement.compile().params]:
+      if p.get('follower_id') is None:
+        dirty = _ALL
+        break
+      dirty.add(p['follower_id'])
+    self._invalidate(cache, dirty)
+    # readers may have cached the uncommitted rows in between; drop them again at the end
+    pending = conn.info.setdefault('follow_graph_dirty', set())
+    if dirty is _ALL or _ALL in pending:
+      conn.info['follow_graph_dirty'] = {_ALL}
+    else:
+      pending.update(dirty)
+
+  def _end(self, cache, conn):
+    dirty = conn.info.pop('follow_graph_dirty', None)
+    if dirty:
+      self._invalidate(cache, _ALL if _ALL in dirty else dirty)
+
+  def _invalidate(self, cache, ids):
+    if ids is _ALL:
+      cache.clear()
+    else:
+      for id in ids:
+        cache.pop(id)
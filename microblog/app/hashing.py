@@ -0,0 +1,111 @@
+"""
+Password hashing off the request thread
+
+PBKDF2 is deliberately slow, and a burst of logins hashing on the request
+threads starves every other request. `PasswordHasher` runs hash and verify
+calls on a pool of PASSWORD_HASH_WORKERS processes, so they neither hold the
+GIL nor outnumber the cores. At most PASSWORD_HASH_MAX_PENDING calls may be
+queued or running at once; past that, callers get `HashingBusy`, a 503 with a
+Retry-After header, instead of joining an ever longer queue. With no workers
+configured, the calls run inline.
+
+The cost comes from PASSWORD_HASH_METHOD, PASSWORD_HASH_ITERATIONS and
+PASSWORD_SALT_LENGTH. `needs_rehash` tells whether a stored hash was made at
+a different cost, so it can be replaced the next time the password is known.
+"""
+
+import atexit
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
+
+
+class HashingBusy(ServiceUnavailable):
+  description = 'Too many sign-ins at once, please try again in a moment.'
+
+  def get_headers(self, environ=None):
+    return super(HashingBusy, self).get_headers(environ) + [('Retry-After', '1')]
+
+
+class _HasherState(object):
+  def __init__(self, app):
+    self.app = app
+    self.lock = threading.Lock()
+    self.pool = None
+    self.slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+
+
+class PasswordHasher(object):
+  """Flask extension hashing and verifying passwords on a bounded process pool"""
+
+  def __init__(self, app=None):
+    self._states = weakref.WeakSet()
+    atexit.register(self.shutdown)
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    app.config.setdefault('PASSWORD_HASH_ITERATIONS', 150000)
+    app.config.setdefault('PASSWORD_SALT_LENGTH', 8)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+    app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 32)
+    state = _HasherState(app)
+    app.extensions['password_hasher'] = state
+    self._states.add(state)
+
+  def method(self):
+    """The werkzeug method string for the configured cost"""
+    config = current_app.config
+    return '{}:{}'.format(config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_ITERATIONS'])
+
+  def hash(self, password):
+    return self._call(generate_password_hash, password, self.method(), current_app.config['PASSWORD_SALT_LENGTH'])
+
+  def verify(self, pwhash, password):
+    return self._call(check_password_hash, pwhash, password)
+
+  def needs_rehash(self, pwhash):
+    """True when `pwhash` was not made with the configured method, rounds and salt length"""
+    if not pwhash or pwhash.count('$') < 2:
+      return True
+    method, salt, _ = pwhash.split('$', 2)
+    return method != self.method() or len(salt) < current_app.config['PASSWORD_SALT_LENGTH']
+
+  def close(self):
+    """Stop the current app's worker processes"""
+    state = current_app.extensions['password_hasher']
+    self._stop(state)
+    self._states.discard(state)
+
+  def shutdown(self):
+    for state in list(self._states):
+      self._stop(state)
+
+  def _stop(self, state):
+    with state.lock:
+      pool, state.pool = state.pool, None
+    if pool is not None:
+      pool.shutdown(wait=False)
+
+  def _call(self, fn, *args):
+    state = current_app.extensions['password_hasher']
+    workers = state.app.config['PASSWORD_HASH_WORKERS']
+    if not workers:
+      return fn(*args)
+    if not state.slots.acquire(blocking=False):
+      raise HashingBusy()
+    try:
+      with state.lock:
+        if state.pool is None:
+          state.pool = ProcessPoolExecutor(max_workers=workers)
+          # an app dropped without close() takes its workers with it
+          weakref.finalize(state, state.pool.shutdown, wait=False)
+        future = state.pool.submit(fn, *args)
+      return future.result()
+    finally:
+      state.slots.release()
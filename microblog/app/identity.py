@@ -0,0 +1,80 @@
+"""
+Identity cache for the login user loader
+
+Flask-Login already keeps the loaded user for the rest of a request; this cache
+saves the primary key lookup at the start of the next ones. Entries are tuples
+of the columns listed in the model's `__identity__`, held in an LRU of
+IDENTITY_CACHE_SIZE users for at most IDENTITY_CACHE_TTL seconds, and are
+turned back into a persistent instance without SQL. Columns left out are
+loaded on first access. Flushing changes to a cached object drops its entry,
+and the entry is dropped again when that transaction ends. Other processes
+and bulk UPDATEs are only caught up with by the TTL.
+"""
+
+from sqlalchemy.orm import make_transient_to_detached
+from flask import current_app
+from app.cache import LRUCache
+
+
+class IdentityCache(object):
+  """Flask extension caching snapshots of the users loaded by `login.user_loader`"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+    app.config.setdefault('IDENTITY_CACHE_TTL', 300)
+    app.extensions['identity_cache'] = LRUCache(app.config['IDENTITY_CACHE_SIZE'], ttl=app.config['IDENTITY_CACHE_TTL'])
+    self.db = db
+    if not getattr(self, '_listening', False):
+      db.event.listen(db.session, 'after_flush', self._after_flush)
+      db.event.listen(db.session, 'after_commit', self._end)
+      db.event.listen(db.session, 'after_rollback', self._end)
+      self._listening = True
+
+  @property
+  def cache(self):
+    return current_app.extensions['identity_cache']
+
+  def load(self, model, id):
+    """`model.query.get(id)`, served from the cache when possible"""
+    session = self.db.session
+    existing = session.identity_map.get(session.identity_key(model, id))
+    if existing is not None:
+      return existing
+    key = (model.__name__, id)
+    snapshot = self.cache.get(key)
+    if snapshot is None:
+      with self.db.primary():
+        obj = model.query.get(id)
+      if obj is not None:
+        self.cache.set(key, tuple(getattr(obj, field) for field in model.__identity__))
+      return obj
+    obj = model()
+    for field, value in zip(model.__identity__, snapshot):
+      setattr(obj, field, value)
+    # persistent as if just loaded; the columns not in the snapshot are expired
+    make_transient_to_detached(obj)
+    session.add(obj)
+    return obj
+
+  def invalidate(self, model, id):
+    self.cache.pop((model.__name__, id))
+
+  def stats(self):
+    return self.cache.stats()
+
+  def _after_flush(self, session, flush_context):
+    changed = session.info.setdefault('identity_changed', set())
+    for obj in list(session.dirty) + list(session.deleted):
+      if hasattr(obj, '__identity__'):
+        key = (type(obj).__name__, obj.id)
+        self.cache.pop(key)
+        changed.add(key)
+
+  def _end(self, session):
+    # readers may have cached the flushed but uncommitted row in between
+    for key in session.info.pop('identity_changed', ()):
+      self.cache.pop(key)
@@ -0,0 +1,313 @@
+"""
+Bulk import
+
+`Importer` streams users, follow edges, posts and messages from JSONL or CSV
+files, optionally gzipped, into the database. Records are read `batch_size`
+at a time and each batch is inserted with one executemany and committed on its
+own, so memory stays flat however large the files are. Usernames are turned
+into ids a batch at a time, through an LRU of recently seen names.
+
+Follows, posts and messages only ever attach to users created since the
+import began, never to an account that was already there under the same name;
+those rows are skipped, and the names are listed in the checkpoint's `taken`.
+
+  users     username, email, and password or password_hash; about_me and last_seen optional
+  follows   follower, followed
+  posts     username, body; timestamp optional
+  messages  sender, recipient, body; timestamp optional
+
+Plaintext passwords are hashed on a pool of processes. At full cost hashing is
+by far the slowest part of an import, so `hash_iterations` can lower it for
+the import; the rehash at login raises each hash to PASSWORD_HASH_ITERATIONS
+the first time its user signs in. Users whose username or email is taken,
+follow edges already there and rows naming users not imported are skipped and
+counted. A malformed record stops the import with its file and line; fix it
+and run the import again to resume.
+
+Nothing is indexed or derived while rows go in. Once every file is loaded,
+the counters, `fanout_on_read` and timelines of the imported users are derived
+in bulk (see `app.synthetic.derive`), then the posts are reindexed.
+
+Progress is saved to a checkpoint file after every batch, and running the
+same import again resumes after the last committed batch. The batch in flight
+when a run stopped may have committed just before, so rows of it already in
+the database are left out when it is replayed.
+"""
+
+import csv
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from time import time
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from app import db
+from app.cache import LRUCache
+from app.models import User, Post, Message, followers
+from app.synthetic import derive
+
+KINDS = ('users', 'follows', 'posts', 'messages')
+
+
+class BadRecord(ValueError):
+  """A record that cannot be read or lacks a field, with where it is"""
+
+  def __init__(self, path, where, error):
+    ValueError.__init__(self, '{}:{}: {}'.format(path, where, error))
+
+
+def read_records(path):
+  """Dicts from a .jsonl (or .ndjson) or .csv file, gzipped if it ends in .gz"""
+  name = path[:-3] if path.endswith('.gz') else path
+  opener = gzip.open if path.endswith('.gz') else open
+  with opener(path, 'rt', encoding='utf-8', newline='') as f:
+    if name.endswith('.csv'):
+      for record in csv.DictReader(f):
+        yield record
+    else:
+      for number, line in enumerate(f, 1):
+        if line.strip():
+          try:
+            yield json.loads(line)
+          except ValueError as e:
+            raise BadRecord(path, number, e)
+
+
+def parse_time(value, default):
+  """Naive UTC datetime from an ISO 8601 string"""
+  if not value:
+    return default
+  moment = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+  if moment.tzinfo is not None:
+    moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+  return moment
+
+
+def insert_ignoring(table):
+  """INSERT that skips rows violating a unique constraint, or None where the dialect has no such thing"""
+  dialect = db.session.get_bind().dialect.name
+  if dialect == 'postgresql':
+    from sqlalchemy.dialects.postgresql import insert
+    return insert(table).on_conflict_do_nothing()
+  if dialect == 'mysql':
+    return table.insert().prefix_with('IGNORE')
+  if dialect == 'sqlite':
+    return table.insert().prefix_with('OR IGNORE')
+  return None
+
+
+class Importer(object):
+  """Loads the files of one import, resuming from `checkpoint` if it exists"""
+
+  def __init__(self, checkpoint, batch_size=10000, hash_workers=None, hash_iterations=None, report=None):
+    self.checkpoint = checkpoint
+    self.batch_size = batch_size
+    self.hash_workers = os.cpu_count() if hash_workers is None else hash_workers
+    config = current_app.config
+    self.hash_method = '{}:{}'.format(config['PASSWORD_HASH_METHOD'], hash_iterations or config['PASSWORD_HASH_ITERATIONS'])
+    self.report = report
+    self.ids = LRUCache(100000)
+    self.pool = None
+
+  def run(self, files, reindex=True):
+    """Import `files`, a `{kind: path}` dict. Returns the checkpoint state."""
+    state = self.load(files)
+    try:
+      for kind in KINDS:
+        if kind in files:
+          self.load_file(state, kind)
+    finally:
+      if self.pool is not None:
+        self.pool.shutdown()
+        self.pool = None
+    if not state['derived']:
+      derive(state['after'])
+      state['derived'] = True
+      self.save(state)
+    if reindex and current_app.search_backend:
+      Post.reindex(checkpoint=self.checkpoint + '.reindex')
+    os.remove(self.checkpoint)
+    return state
+
+  def load(self, files):
+    if os.path.exists(self.checkpoint):
+      with open(self.checkpoint) as f:
+        state = json.load(f)
+      saved = {kind: progress['path'] for kind, progress in state['files'].items()}
+      if saved != {kind: os.path.abspath(path) for kind, path in files.items()}:
+        raise ValueError('{} belongs to an import of other files'.format(self.checkpoint))
+      state['started'] = datetime.fromisoformat(state['started'])
+      self.state = state
+      return state
+    state = {
+      'after': db.session.query(db.func.max(User.id)).scalar() or 0,
+      # default timestamp, the same on every resume
+      'started': datetime.utcnow(),
+      'files': {kind: {'path': os.path.abspath(path), 'done': 0, 'pending': 0, 'skipped': 0} for kind, path in files.items()},
+      # usernames in the users file that belong to someone already there
+      'taken': [],
+      'derived': False,
+    }
+    self.state = state
+    self.save(state)
+    return state
+
+  def save(self, state):
+    temporary = self.checkpoint + '.tmp'
+    with open(temporary, 'w') as f:
+      json.dump(dict(state, started=state['started'].isoformat()), f)
+    os.replace(temporary, self.checkpoint)
+
+  def load_file(self, state, kind):
+    progress = state['files'][kind]
+    records = islice(read_records(progress['path']), progress['done'], None)
+    replaying = progress['pending'] > progress['done']
+    started, loaded = time(), 0
+    while True:
+      batch = list(islice(records, self.batch_size))
+      if not batch:
+        break
+      progress['pending'] = progress['done'] + len(batch)
+      self.save(state)
+      try:
+        rows = getattr(self, 'rows_' + kind)(batch, state['started'])
+      except (KeyError, TypeError, ValueError) as e:
+        where = 'records {}-{}'.format(progress['done'] + 1, progress['pending'])
+        raise BadRecord(progress['path'], where, 'missing field {}'.format(e) if isinstance(e, KeyError) else e)
+      skipped = len(batch) - len(rows)
+      if replaying:
+        rows = self.not_loaded(kind, rows)
+        replaying = False
+      skipped += len(rows) - self.insert(kind, rows)
+      db.session.commit()
+      progress['skipped'] += skipped
+      progress['done'] = progress['pending']
+      self.save(state)
+      loaded += len(batch)
+      if self.report:
+        self.report(kind, progress['done'], progress['skipped'], loaded / max(time() - started, 1e-6))
+
+  def insert(self, kind, rows):
+    if not rows:
+      return 0
+    if kind == 'users':
+      stmt, given = insert_ignoring(User.__table__), rows
+      if stmt is None:
+        stmt, rows = User.__table__.insert(), self.untaken(rows)
+      inserted = 0
+      if rows:
+        result = db.session.execute(stmt, rows)
+        inserted = result.rowcount if result.rowcount >= 0 else len(rows)
+      self.note_taken(given)
+      return inserted
+    table = {'follows': followers, 'posts': Post.__table__, 'messages': Message.__table__}[kind]
+    db.session.execute(table.insert(), rows)
+    return len(rows)
+
+  def untaken(self, rows):
+    """`rows` less the users whose username or email is taken, in the database or earlier in `rows`"""
+    usernames, emails = set(), set()
+    for i in range(0, len(rows), 500):
+      chunk = rows[i:i + 500]
+      usernames.update(name for name, in db.session.query(User.username).filter(
+        User.username.in_([row['username'] for row in chunk])))
+      emails.update(email for email, in db.session.query(User.email).filter(
+        User.email.in_([row['email'] for row in chunk])))
+    kept = []
+    for row in rows:
+      if row['username'] not in usernames and row['email'] not in emails:
+        kept.append(row)
+      usernames.add(row['username'])
+      emails.add(row['email'])
+    return kept
+
+  def note_taken(self, rows):
+    """Add the usernames of `rows` that belong to users from before the import to the checkpoint's `taken`"""
+    usernames, taken = list({row['username'] for row in rows}), set(self.state['taken'])
+    for i in range(0, len(usernames), 500):
+      for username, in db.session.query(User.username).filter(
+          User.username.in_(usernames[i:i + 500]), User.id <= self.state['after']):
+        if username not in taken:
+          self.state['taken'].append(username)
+          taken.add(username)
+
+  def resolve(self, usernames):
+    """`{username: id}` for those of `usernames` created by this import"""
+    found, missing = {}, []
+    taken = set(self.state['taken'])
+    for username in set(usernames):
+      id = self.ids.get(username)
+      if id is None:
+        if username not in taken:
+          missing.append(username)
+      else:
+        found[username] = id
+    for i in range(0, len(missing), 500):
+      for username, id in db.session.query(User.username, User.id).filter(
+          User.username.in_(missing[i:i + 500]), User.id > self.state['after']):
+        found[username] = id
+        self.ids.set(username, id)
+    return found
+
+  def hash_passwords(self, passwords):
+    salt_length = current_app.config['PASSWORD_SALT_LENGTH']
+    if not self.hash_workers:
+      return [generate_password_hash(p, self.hash_method, salt_length) for p in passwords]
+    if self.pool is None:
+      self.pool = ProcessPoolExecutor(max_workers=self.hash_workers)
+    chunksize = max(len(passwords) // (self.hash_workers * 4), 1)
+    return list(self.pool.map(generate_password_hash, passwords, [self.hash_method] * len(passwords),
+      [salt_length] * len(passwords), chunksize=chunksize))
+
+  def rows_users(self, batch, started):
+    plain = [i for i, record in enumerate(batch) if not record.get('password_hash') and record.get('password')]
+    hashes = dict(zip(plain, self.hash_passwords([batch[i]['password'] for i in plain])))
+    return [{
+      'username': record['username'],
+      'email': record['email'],
+      'password_hash': hashes.get(i) or record.get('password_hash') or None,
+      'about_me': record.get('about_me') or None,
+      'last_seen': parse_time(record.get('last_seen'), started),
+    } for i, record in enumerate(batch)]
+
+  def rows_follows(self, batch, started):
+    ids = self.resolve([r['follower'] for r in batch] + [r['followed'] for r in batch])
+    edges = {(ids[r['follower']], ids[r['followed']]) for r in batch
+             if r['follower'] in ids and r['followed'] in ids and r['follower'] != r['followed']}
+    if edges:
+      # an edge already there would break the batch on the unique (follower_id, followed_id) key
+      edges -= set(db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+        followers.c.follower_id.in_(list({follower for follower, followed in edges}))))
+    return [{'follower_id': follower, 'followed_id': followed} for follower, followed in sorted(edges)]
+
+  def rows_posts(self, batch, started):
+    ids = self.resolve(r['username'] for r in batch)
+    return [{
+      'user_id': ids[r['username']],
+      'body': r['body'],
+      'timestamp': parse_time(r.get('timestamp'), started),
+    } for r in batch if r['username'] in ids]
+
+  def rows_messages(self, batch, started):
+    ids = self.resolve([r['sender'] for r in batch] + [r['recipient'] for r in batch])
+    return [{
+      'sender_id': ids[r['sender']],
+      'recipient_id': ids[r['recipient']],
+      'body': r['body'],
+      'timestamp': parse_time(r.get('timestamp'), started),
+    } for r in batch if r['sender'] in ids and r['recipient'] in ids]
+
+  def not_loaded(self, kind, rows):
+    """`rows` less those already in the database, for a batch that may have committed"""
+    if kind in ('users', 'follows') or not rows:
+      # unique usernames and emails, and the check in rows_follows, already keep those out
+      return rows
+    model = Post if kind == 'posts' else Message
+    key = ('user_id', 'timestamp', 'body') if kind == 'posts' else ('sender_id', 'recipient_id', 'timestamp', 'body')
+    existing = set(db.session.query(*[getattr(model, column) for column in key]).filter(
+      getattr(model, key[0]).in_(list({row[key[0]] for row in rows})),
+      model.timestamp.between(min(row['timestamp'] for row in rows), max(row['timestamp'] for row in rows))))
+    return [row for row in rows if tuple(row[column] for column in key) not in existing]
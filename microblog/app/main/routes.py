@@ -2,14 +2,18 @@
 Main section routes
 """
 
-from datetime import datetime
-from flask import jsonify, render_template, flash, redirect, url_for, request, g, current_app
+import json
+from flask import abort, jsonify, render_template, flash, redirect, url_for, request, g, current_app, Response, stream_with_context
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from app import db
+from app import db, last_seen, hub, page_cache, cards, follow_graph
 from app.main import bp
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
+from app.export import export_records, parse_cursor, chunked, compress
 from app.models import User, Post, Message, Notification
+from app.pagination import paginate
+from app.pagecache import newest
+from app.pubsub import HubFull
 
 
 
@@ -17,9 +21,8 @@ from app.models import User, Post, Message, Notification
 def before_request():
   """Execute some logic before the app makes any request"""
   if current_user.is_authenticated:
-    # update last_seen attribute
-    current_user.last_seen = datetime.utcnow()
-    db.session.commit()
+    # update last_seen attribute; the write itself is batched by the buffer
+    last_seen.touch(current_user)
 
     # Set search form for entire application
     g.search_form = SearchForm()
@@ -41,24 +44,31 @@ def index():
     flash(_('Post added.'))
     return redirect(url_for('main.index'))
   # handle pagination
-  page = request.args.get('page', 1, type=int)
-  posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-  next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-  prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+  timeline, keys = current_user.timeline_with_keys()
+  posts = paginate(timeline.options(db.joinedload(Post.author)), *keys, attrs=('timestamp', 'id'))
+  next_url = url_for('main.index', **posts.next_args) if posts.has_next else None
+  prev_url = url_for('main.index', **posts.prev_args) if posts.has_prev else None
   
   return render_template('index.html', title='Home', posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
 
 
 
+def user_version(username):
+  user = User.query.filter_by(username=username).first_or_404()
+  profile = (user.id, user.username, user.email, user.about_me, user.last_seen,
+    user.followers_count, user.followed_count, current_user.is_following(user))
+  return newest(user.posts, Post) + profile
+
+
 @bp.route('/user/<username>')
 @login_required
+@page_cache.cached(user_version)
 def user(username):
   """Display user given by route param"""
   user = User.query.filter_by(username=username).first_or_404()
-  page = request.args.get('page', 1, type=int)
-  posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-  next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-  prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+  posts = paginate(user.posts.options(db.joinedload(Post.author)), Post.timestamp, Post.id)
+  next_url = url_for('main.user', username=user.username, **posts.next_args) if posts.has_next else None
+  prev_url = url_for('main.user', username=user.username, **posts.prev_args) if posts.has_prev else None
 
   return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url)
 
@@ -85,6 +95,7 @@ def edit_profile():
 
 @bp.route('/follow/<username>')
 @login_required
+@db.primary()
 def follow(username):
   """Follow a user given by a route param"""
   user = User.query.filter_by(username=username).first()
@@ -94,7 +105,9 @@ def follow(username):
   if user == current_user:
     flash(_('You cannot follow yourself.'))
     return redirect(url_for('main.user', username=username))
-  current_user.follow(user)
+  if not current_user.follow(user):
+    flash(_('You are already following %(username)s.', username=username))
+    return redirect(url_for('main.user', username=username))
   db.session.commit()
   flash(_('Following %(username)s', username=username))
   return redirect(url_for('main.user', username=username))
@@ -103,6 +116,7 @@ def follow(username):
 
 @bp.route('/unfollow/<username>')
 @login_required
+@db.primary()
 def unfollow(username):
   """Unfollow a user given by a route param"""
   user = User.query.filter_by(username=username).first()
@@ -112,22 +126,30 @@ def unfollow(username):
   if user == current_user:
     flash(_('You cannot unfollow yourself.'))
     return redirect(url_for('main.user', username=username))
-  current_user.unfollow(user)
+  if not current_user.unfollow(user):
+    flash(_('You are not following %(username)s.', username=username))
+    return redirect(url_for('main.user', username=username))
   db.session.commit()
   flash(_('Unfollowed %(username)s', username=username))
   return redirect(url_for('main.user', username=username))
 
 
 
+def explore_version():
+  # the page shows each author's name and avatar: a rename or new email changes it without a new post.
+  # Both lookups read the end of an index; the cursor is already part of the ETag
+  return newest(Post.query, Post) + (db.session.query(db.func.max(User.profile_changed)).scalar(),)
+
+
 @bp.route('/explore')
 @login_required
+@page_cache.cached(explore_version)
 def explore():
   """Handle explore page logic"""
   # handle pagination
-  page = request.args.get('page', 1, type=int)
-  posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-  next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-  prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+  posts = paginate(Post.query.options(db.joinedload(Post.author)), Post.timestamp, Post.id)
+  next_url = url_for('main.explore', **posts.next_args) if posts.has_next else None
+  prev_url = url_for('main.explore', **posts.prev_args) if posts.has_prev else None
   
   return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
 
@@ -140,6 +162,7 @@ def search():
     return redirect(url_for('main.explore'))
   page = request.args.get('page', 1, type=int)
   posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+  posts = posts.options(db.joinedload(Post.author))
   
   if total > page * current_app.config['POSTS_PER_PAGE']:
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1)
@@ -162,6 +185,53 @@ def user_popup(username):
 
 
 
+@bp.route('/users/cards')
+@login_required
+def user_cards():
+  """JSON cards for every `u` in the query string, for the hover popups"""
+  usernames = list(dict.fromkeys(request.args.getlist('u')))
+  if len(usernames) > current_app.config['CARDS_MAX_BATCH']:
+    abort(400)
+  found = cards.get(usernames)
+  result = {}
+  for username, card in found.items():
+    card = dict(card)
+    card['followers_label'] = _('%(count)d followers', count=card['followers'])
+    card['following_label'] = _('%(count)d following', count=card['following'])
+    card['is_following'] = None if card['id'] == current_user.id else \
+      follow_graph.is_following(current_user.id, card['id'])
+    result[username] = card
+  response = jsonify(result)
+  # counts and profiles change under a stable URL: browsers keep the cards but revalidate them
+  response.cache_control.private = True
+  response.cache_control.no_cache = True
+  response.add_etag()
+  return response.make_conditional(request)
+
+
+
+@bp.route('/export')
+@login_required
+def export():
+  """The current user's account as a streamed NDJSON download, resumable from a line's `cursor`"""
+  cursor = request.args.get('cursor')
+  if cursor:
+    try:
+      parse_cursor(cursor)
+    except ValueError:
+      abort(400)
+  chunks = chunked(export_records(current_user._get_current_object(), cursor), current_app.config['EXPORT_CHUNK_SIZE'])
+  response = Response(mimetype='application/x-ndjson', headers={
+    'Content-Disposition': 'attachment; filename="{}.ndjson"'.format(current_user.username),
+    'Cache-Control': 'no-store', 'Vary': 'Accept-Encoding', 'X-Accel-Buffering': 'no'})
+  if request.accept_encodings['gzip']:
+    chunks = compress(chunks)
+    response.headers['Content-Encoding'] = 'gzip'
+  response.response = stream_with_context(chunks)
+  return response
+
+
+
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
@@ -170,6 +240,8 @@ def send_message(recipient):
   if form.validate_on_submit():
     msg = Message(author=current_user, recipient=user, body=form.message.data)
     db.session.add(msg)
+    # applies the counter increment; reading it back is a primary key lookup
+    db.session.flush()
     user.add_notification('unread_message_count', user.new_messages())
     db.session.commit()
     flash(_('Your message has been sent.'))
@@ -181,18 +253,17 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-  current_user.last_message_read_time = datetime.utcnow()
+  current_user.read_messages()
   current_user.add_notification('unread_message_count', 0)
   db.session.commit()
-  page = request.args.get('page', 1, type=int)
-  messages = current_user.messages_received.order_by(Message.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+  messages = paginate(current_user.messages_received.options(db.joinedload(Message.author)), Message.timestamp, Message.id)
   
   if messages.has_next:
-    next_url = url_for('main.messages', page=messages.next_num)
+    next_url = url_for('main.messages', **messages.next_args)
   else:
     next_url = None
   if messages.has_prev:
-    prev_url = url_for('main.messages', page=messages.prev_num)
+    prev_url = url_for('main.messages', **messages.prev_args)
   else:
     prev_url = None
         
@@ -204,9 +275,76 @@ def messages():
 @login_required
 def notifications():
   since = request.args.get('since', 0.0, type=float)
-  notifications = current_user.notifications.filter(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-  return jsonify([{
-    'name': n.name,
-    'data': n.get_data(),
-    'timestamp': n.timestamp
-  } for n in notifications])
\ No newline at end of file
+  return jsonify(Notification.since(current_user.id, since))
+
+
+
+def notifications_since(user, since):
+  """Notifications newer than `since`. The database has those written by every
+  process; the hub adds what this one published that a lagging replica may not have yet."""
+  latest = {event['name']: event for event in Notification.since(user.id, since)}
+  for event in hub.recent(user.id, since) or ():
+    if event['name'] not in latest or latest[event['name']]['timestamp'] < event['timestamp']:
+      latest[event['name']] = event
+  return sorted(latest.values(), key=lambda event: event['timestamp'])
+
+
+
+def hub_full():
+  return Response(status=503, headers={'Retry-After': str(int(current_app.config['NOTIFICATIONS_HEARTBEAT']))})
+
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+  """Server-sent event stream of notifications. Holds the connection open."""
+  since = max(request.args.get('since', 0.0, type=float), request.headers.get('Last-Event-ID', 0.0, type=float))
+  try:
+    sub = hub.subscribe(current_user.id)
+  except HubFull:
+    return hub_full()
+  backlog = notifications_since(current_user, since)
+  heartbeat = current_app.config['NOTIFICATIONS_HEARTBEAT']
+  # don't hold a database connection for the lifetime of the stream
+  db.session.remove()
+
+  def stream():
+    try:
+      # tell EventSource how long to wait before reconnecting
+      yield 'retry: {}\n\n'.format(int(heartbeat * 1000))
+      for event in backlog:
+        yield 'id: {}\ndata: {}\n\n'.format(event['timestamp'], json.dumps(event))
+      while True:
+        event = sub.get(timeout=heartbeat)
+        if event is None:
+          yield ': heartbeat\n\n'
+        else:
+          yield 'id: {}\ndata: {}\n\n'.format(event['timestamp'], json.dumps(event))
+    finally:
+      hub.unsubscribe(sub)
+
+  return Response(stream_with_context(stream()), mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+
+@bp.route('/notifications/poll')
+@login_required
+def notification_poll():
+  """Long-poll fallback for clients without EventSource"""
+  since = request.args.get('since', 0.0, type=float)
+  try:
+    sub = hub.subscribe(current_user.id)
+  except HubFull:
+    return hub_full()
+  try:
+    events = notifications_since(current_user, since)
+    if not events:
+      # don't hold a database connection while waiting
+      db.session.remove()
+      event = sub.get(timeout=current_app.config['NOTIFICATIONS_LONGPOLL_TIMEOUT'])
+      events = [event] if event else []
+  finally:
+    hub.unsubscribe(sub)
+  return jsonify(events)
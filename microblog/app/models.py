@@ -1,25 +1,70 @@
 import json
 from time import time
 from datetime import datetime
+from functools import lru_cache
 from hashlib import md5
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app
 from flask_login import UserMixin
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db, login, hub, indexer, follow_graph, identity, hasher
+from app.search import query_index, index_action, delete_action, bulk_reindex
 import jwt
 
 # Create a table for self-referential relationship with User
 followers = db.Table('followers',
   db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
   db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+  # one per direction: who a user follows, and who follows a user; an edge exists once
+  db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),
+  db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'),
 )
 
+# Materialized home timeline. A row is pushed for every reader of a post when
+# the post is flushed, so the index page reads one pre-sorted slice per user.
+timeline = db.Table('timeline',
+  db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+  db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+  db.Column('timestamp', db.DateTime),
+  db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+def increment(obj, **deltas):
+  """Queue `column = column + delta` updates on obj. They are applied as one
+  atomic UPDATE per row at the next flush, however many times this is called."""
+  if obj is None:
+    # no owner (a post or message without a user id): nothing to count
+    return
+  pending = db.session.info.setdefault('counters', {}).setdefault(obj, {})
+  for name, delta in deltas.items():
+    pending[name] = pending.get(name, 0) + delta
+
+def apply_counters(session, flush_context, instances):
+  for obj, deltas in session.info.pop('counters', {}).items():
+    for name, delta in deltas.items():
+      if obj in session.new:
+        setattr(obj, name, (getattr(obj, name) or 0) + delta)
+      else:
+        setattr(obj, name, getattr(type(obj), name) + delta)
+
+def discard_counters(session):
+  # deltas queued in a rolled back transaction must not reach the next flush
+  session.info.pop('counters', None)
+
+@lru_cache(maxsize=10000)
+def gravatar_url(email, size):
+  """Memoized per address and size, list pages ask for the same few avatars on every row"""
+  digest = md5(email.lower().encode('utf-8')).hexdigest()
+  return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
 @login.user_loader
 def load_user(id):
-  return User.query.get(int(id))
+  return identity.load(User, int(id))
 
 class User(UserMixin, db.Model):
+  # columns kept by the login identity cache: what a request needs of current_user
+  __identity__ = ['id', 'username', 'email', 'last_seen', 'last_message_read_time', 'unread_messages_count',
+    'fanout_on_read', 'followers_count', 'followed_count', 'posts_count']
+
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String(64), index=True, unique=True)
   email = db.Column(db.String(120), index=True, unique=True)
@@ -39,38 +84,119 @@ class User(UserMixin, db.Model):
   messages_received = db.relationship('Message', foreign_keys='Message.recipient_id', backref='recipient', lazy='dynamic')
   last_message_read_time = db.Column(db.DateTime)
   notifications = db.relationship('Notification', backref='user', lazy='dynamic')
+  # set once an account outgrows TIMELINE_FANOUT_LIMIT; its posts are then read on demand
+  fanout_on_read = db.Column(db.Boolean, default=False)
+  # denormalized counters, kept exact by follow(), unfollow() and post inserts
+  followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  # messages received since last_message_read_time; reset by read_messages()
+  unread_messages_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  # when username or email last changed, so pages listing authors can version on max() of it
+  profile_changed = db.Column(db.DateTime, index=True)
 
   def __repr__(self):
     return '<User {}>'.format(self.username)
 
+  @classmethod
+  def before_flush(cls, session, flush_context, instances):
+    for user in [obj for obj in session.dirty if isinstance(obj, User)]:
+      if any(db.inspect(user).attrs[name].history.has_changes() for name in ('username', 'email')):
+        user.profile_changed = datetime.utcnow()
+
   def set_password(self, password):
-    self.password_hash = generate_password_hash(password)
+    self.password_hash = hasher.hash(password)
   
   def check_password(self, password):
-    return check_password_hash(self.password_hash, password)
+    return hasher.verify(self.password_hash, password)
+
+  def password_needs_rehash(self):
+    return hasher.needs_rehash(self.password_hash)
 
   def avatar(self, size):
-    digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+    return gravatar_url(self.email, size)
 
   def follow(self, user):
-    if not self.is_following(user):
-      self.followed.append(user)
+    """Follow `user`. Returns False if this user already did."""
+    if self.has_edge_to(user):
+      return False
+    self.followed.append(user)
+    follow_graph.invalidate(self.id)
+    self.backfill_timeline(user)
+    increment(self, followed_count=1)
+    increment(user, followers_count=1)
+    return True
 
   def unfollow(self, user):
-    if self.is_following(user):
-      self.followed.remove(user)
+    """Unfollow `user`. Returns False if this user did not follow them."""
+    if not self.has_edge_to(user):
+      return False
+    self.followed.remove(user)
+    follow_graph.invalidate(self.id)
+    self.trim_timeline(user)
+    increment(self, followed_count=-1)
+    increment(user, followers_count=-1)
+    return True
 
   def is_following(self, user):
-    return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+    """From the follow-graph cache, which may lag: for display only"""
+    return follow_graph.is_following(self.id, user.id)
+
+  def has_edge_to(self, user):
+    """Whether the followers row exists, asked of the primary database; follow() and unfollow() decide on this"""
+    edge = db.exists().where(db.and_(followers.c.follower_id == self.id, followers.c.followed_id == user.id))
+    with db.primary():
+      return db.session.query(edge).scalar()
 
   def followed_posts(self):
+    ids = follow_graph.followed_ids(self.id)
+    if len(ids) <= current_app.config['FOLLOW_GRAPH_INLINE_LIMIT']:
+      # a short id list beats joining followers
+      return Post.query.filter(Post.user_id.in_(list(ids) + [self.id])).order_by(Post.timestamp.desc())
     followed = Post.query.join(
       followers,
       (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id)
     own = Post.query.filter_by(user_id = self.id)
     return followed.union(own).order_by(Post.timestamp.desc())
 
+  def timeline(self):
+    """Posts for the home page, read from the materialized timeline.
+
+    Accounts flagged `fanout_on_read` are never pushed on write, so their posts
+    are merged in with a `followed_posts()` style query when this user follows one.
+    """
+    return self.timeline_with_keys()[0]
+
+  def timeline_with_keys(self):
+    """`timeline()` and the columns to paginate it on, newest first. Each
+    item holds its key values as `timestamp` and `id`.
+
+    A timeline read only from the materialized rows is keyed on
+    `timeline.c.timestamp, timeline.c.post_id`, so the seek and the sort both
+    run on ix_timeline_user_id_timestamp; a merged one sorts the union on the
+    post columns.
+    """
+    posts = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(timeline.c.user_id == self.id)
+    pulled = self.followed.filter(User.fanout_on_read.is_(True))
+    if db.session.query(pulled.exists()).scalar():
+      pulled_posts = Post.query.filter(Post.user_id.in_(pulled.with_entities(User.id)))
+      return posts.union(pulled_posts).order_by(Post.timestamp.desc()), (Post.timestamp, Post.id)
+    return posts.order_by(timeline.c.timestamp.desc()), (timeline.c.timestamp, timeline.c.post_id)
+
+  def backfill_timeline(self, user):
+    """Copy the newest posts of a newly followed user into this user's timeline"""
+    if user.fanout_on_read:
+      return
+    recent = db.select([db.literal(self.id), Post.id, Post.timestamp]).where(
+      Post.user_id == user.id).order_by(Post.timestamp.desc()).limit(current_app.config['TIMELINE_BACKFILL'])
+    db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], recent))
+
+  def trim_timeline(self, user):
+    """Drop the posts of an unfollowed user from this user's timeline"""
+    db.session.execute(timeline.delete().where(db.and_(
+      timeline.c.user_id == self.id,
+      timeline.c.post_id.in_(db.select([Post.id]).where(Post.user_id == user.id)))))
+
   def get_reset_password_token(self, expires_in=600):
     return jwt.encode({
       "reset_password": self.id,
@@ -78,15 +204,44 @@ class User(UserMixin, db.Model):
     }, current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
 
   def new_messages(self):
-    last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-    return Message.query.filter_by(recipient=self).filter(
-        Message.timestamp > last_read_time).count()
+    return self.unread_messages_count or 0
+
+  def read_messages(self):
+    self.last_message_read_time = datetime.utcnow()
+    self.unread_messages_count = 0
+    # an increment queued earlier in this session counts as read too
+    db.session.info.get('counters', {}).get(self, {}).pop('unread_messages_count', None)
 
   def add_notification(self, name, data):
-    self.notifications.filter_by(name=name).delete()
-    n = Notification(name=name, payload_json=json.dumps(data), user=self)
-    db.session.add(n)
-    return n
+    event = {'name': name, 'data': data, 'timestamp': time()}
+    Notification.upsert(self.id, name, json.dumps(data), event['timestamp'])
+    # handed to the notification hub once the transaction commits
+    db.session.info.setdefault('notifications', []).append((self.id, event))
+    return event
+
+  @classmethod
+  def counter_queries(cls):
+    """Correlated subqueries computing each denormalized counter from scratch"""
+    return {
+      'followers_count': db.select([db.func.count()]).where(followers.c.followed_id == cls.id).as_scalar(),
+      'followed_count': db.select([db.func.count()]).where(followers.c.follower_id == cls.id).as_scalar(),
+      'posts_count': db.select([db.func.count(Post.id)]).where(Post.user_id == cls.id).as_scalar(),
+      'unread_messages_count': db.select([db.func.count(Message.id)]).where(db.and_(
+        Message.recipient_id == cls.id,
+        Message.timestamp > db.func.coalesce(cls.last_message_read_time, datetime(1900, 1, 1)))).as_scalar(),
+    }
+
+  @classmethod
+  def reconcile_counters(cls, batch_size=500, after=0):
+    """Recompute the counters of every user with an id above `after` that has drifted. Returns their ids."""
+    queries = cls.counter_queries()
+    drifted = [id for id, in db.session.query(cls.id).filter(cls.id > after,
+      db.or_(*[getattr(cls, name) != query for name, query in queries.items()]))]
+    for i in range(0, len(drifted), batch_size):
+      db.session.execute(cls.__table__.update().where(cls.id.in_(drifted[i:i + batch_size])).values(**queries))
+    for id in drifted:
+      identity.invalidate(cls, id)
+    return drifted
 
   @staticmethod
   def verify_reset_password_token(token):
@@ -109,38 +264,57 @@ class SearchableMixin(object):
     return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
   @classmethod
-  def before_commit(cls, session):
-    session._changes = {
-      'add': list(session.new),
-      'update': list(session.dirty),
-      'delete': list(session.deleted)
-    }
+  def after_flush(cls, session, flush_context):
+    # snapshot the documents while ids and attributes are loaded; they are
+    # handed to the indexer only if the transaction commits
+    changes = session.info.setdefault('search_changes', {})
+    for obj in list(session.new) + list(session.dirty):
+      if isinstance(obj, SearchableMixin):
+        changes[(obj.__tablename__, obj.id)] = index_action(obj)
+    for obj in session.deleted:
+      if isinstance(obj, SearchableMixin):
+        changes[(obj.__tablename__, obj.id)] = delete_action(obj)
 
   @classmethod
   def after_commit(cls, session):
-    for obj in session._changes['add']:
-      if isinstance(obj, SearchableMixin):
-        add_to_index(obj.__tablename__, obj)
-    for obj in session._changes['update']:
-      if isinstance(obj, SearchableMixin):
-        add_to_index(obj.__tablename__, obj)
-    for obj in session._changes['delete']:
-      if isinstance(obj, SearchableMixin):
-        remove_from_index(obj.__tablename__, obj)
-    session._changes = None
+    changes = session.info.pop('search_changes', None)
+    if changes:
+      indexer.enqueue(list(changes.values()))
+
+  @classmethod
+  def after_rollback(cls, session):
+    session.info.pop('search_changes', None)
 
   @classmethod
-  def reindex(cls):
-    for obj in cls.query:
-      add_to_index(cls.__tablename__, obj)
+  def reindex(cls, chunk_size=1000, workers=4, checkpoint=None, report=None):
+    """Rebuild the index from the table, streaming id-ranged chunks to parallel bulk workers"""
+    columns = [getattr(cls, field) for field in cls.__searchable__]
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    def chunks(after):
+      while True:
+        # keyset on the primary key: only the indexed columns, one chunk in memory at a time
+        rows = db.session.query(cls.id, *columns).filter(cls.id > after).order_by(cls.id).limit(chunk_size).all()
+        if not rows:
+          return
+        after = rows[-1].id
+        yield after, [{
+          'op': 'index',
+          'index': cls.__tablename__,
+          'id': row.id,
+          'body': {field: getattr(row, field) for field in cls.__searchable__}
+        } for row in rows]
+
+    return bulk_reindex(cls.__tablename__, chunks, workers=workers, checkpoint=checkpoint, report=report)
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class Post(SearchableMixin, db.Model):
   # List fields to include in search index
   __searchable__ = ['body']
+  __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
   id = db.Column(db.Integer, primary_key=True)
   body = db.Column(db.String(140))
@@ -150,9 +324,46 @@ class Post(SearchableMixin, db.Model):
   def __repr__(self):
     return '<Post {}>'.format(self.body)
 
+  @classmethod
+  def before_flush(cls, session, flush_context, instances):
+    for post in [obj for obj in session.new if isinstance(obj, Post)]:
+      increment(post.author or (post.user_id and User.query.get(post.user_id)), posts_count=1)
+    deleted = [obj for obj in session.deleted if isinstance(obj, Post)]
+    for post in deleted:
+      increment(post.author, posts_count=-1)
+    # timeline rows reference the post, so they go before the post row does
+    if deleted:
+      session.execute(timeline.delete().where(timeline.c.post_id.in_([post.id for post in deleted])))
+
+  @classmethod
+  def after_flush(cls, session, flush_context):
+    for post in [obj for obj in session.new if isinstance(obj, Post)]:
+      post.fan_out(session)
+
+  def fan_out(self, session):
+    """Push a freshly inserted post into the timelines of its author and followers"""
+    session.execute(timeline.insert().values(user_id=self.user_id, post_id=self.id, timestamp=self.timestamp))
+    author = self.author
+    if author.fanout_on_read:
+      return
+    if author.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+      # too many readers to push to; from now on the author's posts are pulled at read time
+      session.execute(User.__table__.update().where(User.id == self.user_id).values(fanout_on_read=True))
+      set_committed_value(author, 'fanout_on_read', True)
+      identity.invalidate(User, self.user_id)
+      return
+    readers = db.select([followers.c.follower_id, db.literal(self.id), db.literal(self.timestamp)]).where(
+      followers.c.followed_id == self.user_id)
+    session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], readers))
+
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+
 
 
 class Message(db.Model):
+  __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),)
+
   id = db.Column(db.Integer, primary_key=True)
   sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
   recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -162,8 +373,26 @@ class Message(db.Model):
   def __repr__(self):
       return '<Message {}>'.format(self.body)
 
+  @classmethod
+  def before_flush(cls, session, flush_context, instances):
+    for message in [obj for obj in session.new if isinstance(obj, Message)]:
+      increment(message.recipient or (message.recipient_id and User.query.get(message.recipient_id)), unread_messages_count=1)
+
+db.event.listen(db.session, 'before_flush', Message.before_flush)
+db.event.listen(db.session, 'before_flush', User.before_flush)
+# registered last so it also applies the counts queued by the listeners above
+db.event.listen(db.session, 'before_flush', apply_counters)
+db.event.listen(db.session, 'after_rollback', discard_counters)
+
 
 class Notification(db.Model):
+  __table_args__ = (
+    # one row per user and name, replaced in place by upsert()
+    db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),
+    # since() seeks here; see since_query for why it does not cover the query
+    db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+  )
+
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(128), index=True)
   user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -171,4 +400,74 @@ class Notification(db.Model):
   payload_json = db.Column(db.Text)
 
   def get_data(self):
-    return json.loads(str(self.payload_json))
\ No newline at end of file
+    return json.loads(str(self.payload_json))
+
+  def to_dict(self):
+    return {'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+  @classmethod
+  def upsert(cls, user_id, name, payload_json, timestamp):
+    """Insert the notification, or replace the user's existing one of that name, in one statement"""
+    values = {'user_id': user_id, 'name': name, 'payload_json': payload_json, 'timestamp': timestamp}
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+      from sqlalchemy.dialects.postgresql import insert
+      stmt = insert(cls.__table__).values(**values)
+      stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'name'],
+        set_={'payload_json': stmt.excluded.payload_json, 'timestamp': stmt.excluded.timestamp})
+    elif dialect == 'mysql':
+      from sqlalchemy.dialects.mysql import insert
+      stmt = insert(cls.__table__).values(**values)
+      stmt = stmt.on_duplicate_key_update(payload_json=stmt.inserted.payload_json, timestamp=stmt.inserted.timestamp)
+    elif dialect == 'sqlite':
+      # SQLAlchemy 1.3 has no SQLite upsert construct; the syntax needs SQLite 3.24+
+      stmt = db.text(
+        'INSERT INTO notification (user_id, name, payload_json, timestamp) '
+        'VALUES (:user_id, :name, :payload_json, :timestamp) '
+        'ON CONFLICT (user_id, name) DO UPDATE SET payload_json = excluded.payload_json, timestamp = excluded.timestamp')
+    else:
+      if db.session.execute(cls.__table__.update().where(db.and_(
+          cls.user_id == user_id, cls.name == name)).values(payload_json=payload_json, timestamp=timestamp)).rowcount:
+        return
+      stmt = cls.__table__.insert()
+    db.session.execute(stmt, values)
+
+  @classmethod
+  def since_query(cls, user_id, since):
+    # The (user_id, timestamp) index finds the rows without covering them, so
+    # name and payload_json are read from the table. That is a lookup per row
+    # for the handful a user has (upsert() keeps one per name), and it keeps
+    # payload_json, a Text MySQL cannot index unprefixed, out of the index.
+    return db.session.query(cls.name, cls.payload_json, cls.timestamp).filter(
+      cls.user_id == user_id, cls.timestamp > since).order_by(cls.timestamp.asc())
+
+  @classmethod
+  def since(cls, user_id, since):
+    """Event dicts for the notifications of `user_id` newer than `since`, oldest first"""
+    return [{'name': name, 'data': json.loads(payload), 'timestamp': timestamp}
+      for name, payload, timestamp in cls.since_query(user_id, since)]
+
+  @classmethod
+  def prune(cls, older_than, batch_size=1000):
+    """Delete notifications last updated before `older_than` (epoch seconds),
+    committing every `batch_size` rows. Returns the number deleted."""
+    deleted = 0
+    while True:
+      ids = [id for id, in db.session.query(cls.id).filter(cls.timestamp < older_than).limit(batch_size)]
+      if not ids:
+        return deleted
+      db.session.execute(cls.__table__.delete().where(cls.id.in_(ids)))
+      db.session.commit()
+      deleted += len(ids)
+
+  @classmethod
+  def after_commit(cls, session):
+    for user_id, event in session.info.pop('notifications', []):
+      hub.publish(user_id, event)
+
+  @classmethod
+  def after_rollback(cls, session):
+    session.info.pop('notifications', None)
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
@@ -0,0 +1,109 @@
+"""
+Conditional GET and page cache
+
+Views decorated with `page_cache.cached(version)` get an ETag built from the
+route, its query string, the locale, what the navigation bar shows the viewer
+and `version(**view_args)`, which returns the newest `(timestamp, id)` of the
+posts the page lists plus whatever else the page shows, such as when an
+author's name or email last changed. It should be a few index lookups: a
+request whose If-None-Match matches is answered 304 without running the view. Last-Modified is sent as the newest post's
+timestamp, but If-Modified-Since alone never earns a 304: it cannot see the
+viewer or a changed profile.
+
+Rendered pages are also kept per process, keyed by the ETag, in an LRU of
+PAGE_CACHE_SIZE bytes for at most PAGE_CACHE_TTL seconds. A change to what a
+page shows changes its ETag, so other processes never serve it stale;
+committing changes to posts, who follows whom or a user's name or email also
+empties this process's cache, to free the entries nobody can hit any more.
+Pages with flashed messages are never cached.
+"""
+
+from functools import wraps
+from hashlib import sha1
+from flask import current_app, g, request, session
+from flask_login import current_user
+from sqlalchemy import inspect
+from werkzeug.http import is_resource_modified
+from app.cache import LRUCache
+
+
+def newest(query, model):
+  """`(timestamp, id)` of the newest row of `query`, or `(None, None)`"""
+  row = query.order_by(None).order_by(model.timestamp.desc(), model.id.desc()).with_entities(
+    model.timestamp, model.id).first()
+  return tuple(row) if row else (None, None)
+
+
+class PageCache(object):
+  """Flask extension answering conditional GETs and caching rendered pages"""
+
+  def __init__(self, app=None, db=None):
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('PAGE_CACHE_SIZE', 64 * 1024 * 1024)
+    app.config.setdefault('PAGE_CACHE_TTL', 300)
+    app.extensions['page_cache'] = LRUCache(app.config['PAGE_CACHE_SIZE'], ttl=app.config['PAGE_CACHE_TTL'], weigh=len)
+    if not getattr(self, '_listening', False):
+      db.event.listen(db.session, 'after_flush', self._after_flush)
+      db.event.listen(db.session, 'after_commit', self._after_commit)
+      db.event.listen(db.session, 'after_rollback', lambda session: session.info.pop('page_cache_dirty', None))
+      self._listening = True
+
+  @property
+  def cache(self):
+    return current_app.extensions['page_cache']
+
+  def cached(self, version):
+    """Decorate a GET view; `version` is called with the view arguments"""
+    def decorator(f):
+      @wraps(f)
+      def wrapped(**kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+          return f(**kwargs)
+        stamp = version(**kwargs)
+        viewer = (current_user.id, current_user.username, current_user.new_messages(), current_user.followed_count) \
+          if current_user.is_authenticated else None
+        state = (request.endpoint, sorted(request.args.items(multi=True)), g.get('locale'), viewer, stamp)
+        etag = sha1(repr(state).encode('utf-8')).hexdigest()
+        last_modified = stamp[0] if stamp and stamp[0] is not None else None
+
+        if not is_resource_modified(request.environ, etag=etag):
+          response = current_app.response_class(status=304)
+        else:
+          cache = self.cache
+          body = cache.get(etag)
+          if body is not None:
+            response = current_app.response_class(body, mimetype='text/html')
+          else:
+            response = current_app.make_response(f(**kwargs))
+            if response.status_code != 200:
+              return response
+            if current_app.config['PAGE_CACHE_SIZE']:
+              cache.set(etag, response.get_data())
+        response.set_etag(etag)
+        if last_modified is not None:
+          response.last_modified = last_modified
+        # personal pages: browsers may keep them but must ask first
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+      return wrapped
+    return decorator
+
+  def clear(self):
+    self.cache.clear()
+
+  def _after_flush(self, session, flush_context):
+    from app.models import User, Post
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+      if isinstance(obj, Post) or (isinstance(obj, User) and any(
+          inspect(obj).attrs[name].history.has_changes() for name in ('followed', 'username', 'email'))):
+        session.info['page_cache_dirty'] = True
+        return
+
+  def _after_commit(self, session):
+    if session.info.pop('page_cache_dirty', False):
+      self.clear()
+
@@ -0,0 +1,116 @@
+"""
+Pagination helpers
+
+List pages are paginated on a sort key such as `(timestamp, id)` rather than
+with OFFSET, so deep pages cost the same as the first one and no COUNT is
+needed. Page positions travel in the query string as opaque cursor tokens.
+"""
+
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import abort, current_app, request
+from app import db
+
+
+def encode_cursor(values, direction):
+  """Pack sort key values and a direction ('n'ext or 'p'rev) into a url-safe token"""
+  packed = [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+  raw = json.dumps([direction, packed], separators=(',', ':')).encode('utf-8')
+  return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+  """Inverse of `encode_cursor`. Raises ValueError for malformed tokens."""
+  try:
+    direction, packed = json.loads(urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    values = [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v for v in packed]
+  except Exception as e:
+    raise ValueError('invalid cursor') from e
+  if direction not in ('n', 'p'):
+    raise ValueError('invalid cursor')
+  return values, direction
+
+
+def _seek(keys, values, older):
+  """Row-value comparison `keys < values` (or `>`) spelled out for every backend"""
+  key, value = keys[0], values[0]
+  head = key < value if older else key > value
+  if len(keys) == 1:
+    return head
+  return db.or_(head, db.and_(key == value, _seek(keys[1:], values[1:], older)))
+
+
+class Page(object):
+  """One page of results with the query string arguments for its neighbours.
+
+  `next_args` and `prev_args` are meant to be splatted into `url_for`.
+  """
+
+  def __init__(self, items, next_args=None, prev_args=None):
+    self.items = items
+    self.next_args = next_args
+    self.prev_args = prev_args
+
+  @property
+  def has_next(self):
+    return self.next_args is not None
+
+  @property
+  def has_prev(self):
+    return self.prev_args is not None
+
+
+def keyset_paginate(query, keys, cursor, per_page, attrs=None):
+  """Return the page of `query` after (or before) `cursor`, newest first by `keys`.
+
+  `attrs` names the attributes of the items holding each key's value, for
+  keys such as `timeline.c.post_id` that the items know under another name;
+  it defaults to the keys' own names.
+  """
+  attrs = attrs or [key.key for key in keys]
+  query = query.order_by(None)
+  if cursor is None:
+    values, direction = None, 'n'
+  else:
+    try:
+      values, direction = decode_cursor(cursor)
+    except ValueError:
+      abort(400)
+    if len(values) != len(keys):
+      abort(400)
+  older = direction == 'n'
+  if values is not None:
+    query = query.filter(_seek(keys, values, older))
+  order = [key.desc() if older else key.asc() for key in keys]
+  items = query.order_by(*order).limit(per_page + 1).all()
+  more = len(items) > per_page
+  items = items[:per_page]
+  if not older:
+    items.reverse()
+
+  def args(item, direction):
+    return {'cursor': encode_cursor([getattr(item, attr) for attr in attrs], direction)}
+
+  has_next = more if older else True
+  has_prev = values is not None if older else more
+  return Page(items,
+    next_args=args(items[-1], 'n') if has_next and items else None,
+    prev_args=args(items[0], 'p') if has_prev and items else None)
+
+
+def offset_paginate(query, keys, page, per_page):
+  """Classic LIMIT/OFFSET pagination, kept for PAGINATION_MODE = 'offset'"""
+  query = query.order_by(None).order_by(*[key.desc() for key in keys])
+  result = query.paginate(page, per_page, False)
+  return Page(result.items,
+    next_args={'page': result.next_num} if result.has_next else None,
+    prev_args={'page': result.prev_num} if result.has_prev else None)
+
+
+def paginate(query, *keys, attrs=None):
+  """Paginate `query` newest first on `keys` using the request's `cursor`/`page` argument"""
+  per_page = current_app.config['POSTS_PER_PAGE']
+  if current_app.config['PAGINATION_MODE'] == 'offset':
+    return offset_paginate(query, keys, request.args.get('page', 1, type=int), per_page)
+  return keyset_paginate(query, keys, request.args.get('cursor'), per_page, attrs)
@@ -0,0 +1,127 @@
+"""
+Per-request profiling
+
+Off unless PROFILE_REQUESTS is set. Each request then records how many SQL
+statements it ran and how long they took, the time spent rendering Jinja
+templates and the time spent in the `before_request` functions. The numbers
+are sent back in a `Server-Timing` header, which browser developer tools show
+next to the network timings, and logged as one JSON line per request.
+Requests taking longer than PROFILE_SLOW_REQUEST_MS are logged as warnings
+together with the statements they ran. Statements run lazily from a template
+count towards both `sql` and `render`.
+"""
+
+import json
+from time import perf_counter
+from flask import current_app, g, has_app_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class _Profile(object):
+  def __init__(self):
+    self.start = perf_counter()
+    self.before_request = 0.0
+    self.sql_count = 0
+    self.sql_time = 0.0
+    self.render_time = 0.0
+    self.rendering = []
+    self.statements = []
+
+
+def _active():
+  return g.get('_profile') if has_app_context() else None
+
+
+class RequestProfiler(object):
+  """Flask extension timing SQL, template rendering and `before_request` per request"""
+
+  def __init__(self, app=None):
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('PROFILE_REQUESTS', False)
+    app.config.setdefault('PROFILE_SLOW_REQUEST_MS', 500)
+    if not app.config['PROFILE_REQUESTS']:
+      return
+    if not getattr(self, '_listening', False):
+      # every engine, so binds created later are covered too
+      event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+      event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+      self._listening = True
+    before_render_template.connect(self._before_render, app)
+    template_rendered.connect(self._rendered, app)
+
+    # Flask has no hook after the last before_request function, so time the whole phase
+    preprocess_request = app.preprocess_request
+
+    def profiled_preprocess_request():
+      profile = g._profile = _Profile()
+      try:
+        return preprocess_request()
+      finally:
+        profile.before_request = perf_counter() - profile.start
+
+    app.preprocess_request = profiled_preprocess_request
+    # registered before the blueprints' handlers, so it runs after them
+    app.after_request(self._after_request)
+    app.teardown_request(lambda exc: g.pop('_profile', None))
+
+  def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    if _active() is not None:
+      conn.info.setdefault('profile_started', []).append(perf_counter())
+
+  def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    profile = _active()
+    if profile is None or not conn.info.get('profile_started'):
+      return
+    elapsed = perf_counter() - conn.info['profile_started'].pop()
+    profile.sql_count += 1
+    profile.sql_time += elapsed
+    profile.statements.append((elapsed, statement))
+
+  def _before_render(self, app, template, context):
+    profile = _active()
+    if profile is not None:
+      profile.rendering.append(perf_counter())
+
+  def _rendered(self, app, template, context):
+    profile = _active()
+    if profile is not None and profile.rendering:
+      started = profile.rendering.pop()
+      # only the outermost render, a template rendered from another is already inside it
+      if not profile.rendering:
+        profile.render_time += perf_counter() - started
+
+  def _after_request(self, response):
+    profile = g.pop('_profile', None)
+    if profile is None:
+      return response
+    total = perf_counter() - profile.start
+    ms = lambda seconds: round(seconds * 1000, 1)
+    response.headers['Server-Timing'] = ', '.join([
+      'sql;desc="{} statements";dur={}'.format(profile.sql_count, ms(profile.sql_time)),
+      'render;dur={}'.format(ms(profile.render_time)),
+      'before-request;dur={}'.format(ms(profile.before_request)),
+      'total;dur={}'.format(ms(total)),
+    ])
+    record = {
+      'method': request.method,
+      'path': request.path,
+      'endpoint': request.endpoint,
+      'status': response.status_code,
+      'total_ms': ms(total),
+      'sql_count': profile.sql_count,
+      'sql_ms': ms(profile.sql_time),
+      'render_ms': ms(profile.render_time),
+      'before_request_ms': ms(profile.before_request),
+    }
+    current_app.logger.info('request %s', json.dumps(record))
+    threshold = current_app.config['PROFILE_SLOW_REQUEST_MS']
+    if threshold and total * 1000 >= threshold:
+      current_app.logger.warning('slow request %s %s took %.1f ms, %d statements:\n%s',
+        request.method, request.path, total * 1000, profile.sql_count,
+        '\n'.join('  {:8.1f} ms  {}'.format(elapsed * 1000, ' '.join(statement.split()))
+                  for elapsed, statement in profile.statements))
+    return response
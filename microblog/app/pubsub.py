@@ -0,0 +1,116 @@
+"""
+In-process notification hub
+
+Open notification streams subscribe here and `User.add_notification` publishes
+here once its transaction commits, so an idle client costs a held connection
+rather than a database query every few seconds. The hub lives in process
+memory: run a single (threaded) server process, or put a broker in front of it
+before scaling out.
+"""
+
+import queue
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+
+class HubFull(Exception):
+  """Raised when NOTIFICATIONS_MAX_CONNECTIONS streams are already open"""
+
+
+class Subscription(object):
+  """A single open stream. `get` blocks until an event arrives or `timeout` passes."""
+
+  def __init__(self, user_id):
+    self.user_id = user_id
+    self.queue = queue.Queue()
+
+  def get(self, timeout=None):
+    try:
+      return self.queue.get(timeout=timeout)
+    except queue.Empty:
+      return None
+
+
+class _HubState(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.subscribers = {}
+    self.connections = 0
+    self.recent = OrderedDict()
+
+
+class NotificationHub(object):
+  """Fan notification events out to the open streams of each user.
+
+  The latest event of each name is remembered for the most recent
+  NOTIFICATIONS_RECENT_USERS users. It only holds what this process
+  published, so catching a reconnecting client up still starts from the
+  database, with these filling in what a lagging replica has not seen yet.
+  """
+
+  def __init__(self, app=None):
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('NOTIFICATIONS_MAX_CONNECTIONS', 1000)
+    app.config.setdefault('NOTIFICATIONS_HEARTBEAT', 15)
+    app.config.setdefault('NOTIFICATIONS_LONGPOLL_TIMEOUT', 30)
+    app.config.setdefault('NOTIFICATIONS_RECENT_USERS', 10000)
+    app.extensions['notification_hub'] = _HubState()
+
+  @property
+  def _state(self):
+    return current_app.extensions['notification_hub']
+
+  def subscribe(self, user_id):
+    state = self._state
+    with state.lock:
+      if state.connections >= current_app.config['NOTIFICATIONS_MAX_CONNECTIONS']:
+        raise HubFull()
+      sub = Subscription(user_id)
+      state.subscribers.setdefault(user_id, set()).add(sub)
+      state.connections += 1
+    return sub
+
+  def unsubscribe(self, sub):
+    state = self._state
+    with state.lock:
+      subs = state.subscribers.get(sub.user_id, set())
+      if sub in subs:
+        subs.discard(sub)
+        state.connections -= 1
+      if not subs:
+        state.subscribers.pop(sub.user_id, None)
+
+  @property
+  def connections(self):
+    return self._state.connections
+
+  def publish(self, user_id, event):
+    """Deliver `event` (a dict with name, data and timestamp) to every stream of `user_id`"""
+    state = self._state
+    with state.lock:
+      self._remember(state, user_id, [event])
+      subs = list(state.subscribers.get(user_id, ()))
+    for sub in subs:
+      sub.queue.put(event)
+
+  def recent(self, user_id, since):
+    """Events newer than `since`, or None when the hub knows nothing about `user_id`"""
+    state = self._state
+    with state.lock:
+      latest = state.recent.get(user_id)
+      if latest is None:
+        return None
+      state.recent.move_to_end(user_id)
+      return sorted((e for e in latest.values() if e['timestamp'] > since), key=lambda e: e['timestamp'])
+
+  def _remember(self, state, user_id, events):
+    latest = state.recent.setdefault(user_id, {})
+    state.recent.move_to_end(user_id)
+    for event in events:
+      latest[event['name']] = event
+    while len(state.recent) > current_app.config['NOTIFICATIONS_RECENT_USERS']:
+      state.recent.popitem(last=False)
@@ -0,0 +1,122 @@
+"""
+Read-replica routing
+
+With SQLALCHEMY_REPLICA_URIS set, `RoutingSession` sends the SELECTs of GET
+and HEAD requests to the replicas, round robin, and everything else to the
+primary: flushes, bulk and textual statements, the whole rest of a
+transaction once it has written, and all work outside a request. The
+replicas are registered as `replica_<n>` binds, which no table belongs to, so
+`create_all` and migrations still only touch the primary.
+
+Replicas lag behind, so a request that commits a write marks the user's
+session to read from the primary for REPLICA_STICKY_SECONDS afterwards, and
+they see what they just did. Reads that decide a write, or that fill a cache
+kept beyond the request, must not see that lag at all: they go inside
+`db.primary()`, which also decorates the GET views that write.
+
+To try it locally, back the SQLite database up and point a replica at the
+copy (a plain `cp` can miss commits still in the WAL file):
+
+  sqlite3 app.db ".backup replica.db"
+  export DATABASE_REPLICA_URLS=sqlite:///$PWD/replica.db
+"""
+
+import re
+from contextlib import contextmanager
+from itertools import count
+from time import time
+from flask import has_request_context, request, session as cookie
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import SelectBase, TextClause
+from app.engines import pool_options, sqlite_pragmas
+
+STICKY_KEY = '_db_primary_until'
+SELECT = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+
+def _reads_only(clause):
+  if isinstance(clause, SelectBase):
+    return True
+  return isinstance(clause, TextClause) and SELECT.match(clause.text) is not None
+
+
+class RoutingSession(SignallingSession):
+  """Session picking a replica or the primary for every statement"""
+
+  def get_bind(self, mapper=None, clause=None):
+    if self._flushing or (clause is not None and not _reads_only(clause)):
+      self.info['wrote'] = True
+    replicas = self.app.extensions['replicas']
+    if (replicas and not self.info.get('wrote') and not self.info.get('primary') and _may_read_replica() and
+        not _bound(mapper)):
+      key = replicas['keys'][next(replicas['counter']) % len(replicas['keys'])]
+      return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=key)
+    return SignallingSession.get_bind(self, mapper, clause)
+
+
+def _bound(mapper):
+  return mapper is not None and mapper.persist_selectable.info.get('bind_key') is not None
+
+
+def _may_read_replica():
+  return (has_request_context() and request.method in ('GET', 'HEAD') and
+          cookie.get(STICKY_KEY, 0) < time())
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  """`SQLAlchemy` whose session routes reads to the replicas, and whose engines are tuned by `app.engines`"""
+
+  def init_app(self, app):
+    app.config.setdefault('DATABASE_POOL_SIZE', 5)
+    app.config.setdefault('DATABASE_MAX_OVERFLOW', 10)
+    app.config.setdefault('DATABASE_POOL_RECYCLE', None)
+    app.config.setdefault('DATABASE_POOL_PRE_PING', False)
+    for key in ('SQLITE_JOURNAL_MODE', 'SQLITE_SYNCHRONOUS', 'SQLITE_MMAP_SIZE', 'SQLITE_CACHE_SIZE', 'SQLITE_BUSY_TIMEOUT'):
+      app.config.setdefault(key, None)
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    uris = app.config['SQLALCHEMY_REPLICA_URIS']
+    keys = ['replica_{}'.format(i) for i in range(len(uris))]
+    if uris:
+      binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+      binds.update(zip(keys, uris))
+      app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['replicas'] = {'keys': keys, 'counter': count()} if uris else None
+    SQLAlchemy.init_app(self, app)
+
+  def apply_driver_hacks(self, app, sa_url, options):
+    SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+    pool_options(app.config, sa_url, options)
+
+  def create_engine(self, sa_url, engine_opts):
+    engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+    if engine.dialect.name == 'sqlite':
+      event.listen(engine, 'connect', sqlite_pragmas(self.get_app().config))
+    return engine
+
+  @contextmanager
+  def primary(self):
+    """Send every statement made inside to the primary. Works as a decorator too."""
+    info = self.session().info
+    info['primary'] = info.get('primary', 0) + 1
+    try:
+      yield
+    finally:
+      info['primary'] -= 1
+
+  def create_session(self, options):
+    factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+    event.listen(factory, 'after_commit', _after_commit)
+    event.listen(factory, 'after_transaction_end', _after_transaction_end)
+    return factory
+
+
+def _after_commit(session):
+  if session.info.get('wrote') and session.app.extensions['replicas'] and has_request_context():
+    cookie[STICKY_KEY] = time() + session.app.config['REPLICA_STICKY_SECONDS']
+
+
+def _after_transaction_end(session, transaction):
+  if transaction.parent is None:
+    session.info.pop('wrote', None)
@@ -1,27 +1,337 @@
+"""
+Search backends and the indexing pipeline
+
+`add_to_index`, `remove_from_index` and `query_index` talk to whichever
+backend `create_app` installed on `app.search_backend`: Elasticsearch when
+ELASTICSEARCH_URL is set, otherwise the embedded SQLite FTS5 engine. A backend
+implements `bulk(actions)` and `query(index, expression, page, per_page)`.
+"""
+
+import atexit
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 from flask import current_app
 
 def add_to_index(index, model):
-  if not current_app.elasticsearch:
+  if not current_app.search_backend:
     return
   payload = {}
 
   for field in model.__searchable__:
     payload[field] = getattr(model, field)
-  
-  current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload)
+
+  current_app.search_backend.bulk([{'op': 'index', 'index': index, 'id': model.id, 'body': payload}])
 
 def remove_from_index(index, model):
-  if not current_app.elasticsearch:
+  if not current_app.search_backend:
     return
-  current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+  current_app.search_backend.bulk([{'op': 'delete', 'index': index, 'id': model.id}])
 
 def query_index(index, query, page, per_page):
-  if not current_app.elasticsearch:
+  if not current_app.search_backend:
     return [], 0
-  search = current_app.elasticsearch.search(
-    index=index,
-    doc_type=index,
-    body={'query': {'multi_match': {'query': query, 'fields': ['*']}},'from': (page - 1) * per_page, 'size': per_page}
-    )
-  ids = [int(hit['_id']) for hit in search['hits']['hits']]
-  return ids, search['hits']['total']
\ No newline at end of file
+  return current_app.search_backend.query(index, query, page, per_page)
+
+
+def index_action(model):
+  """Snapshot `model` into a bulk index action"""
+  return {
+    'op': 'index',
+    'index': model.__tablename__,
+    'id': model.id,
+    'body': {field: getattr(model, field) for field in model.__searchable__}
+  }
+
+def delete_action(model):
+  return {'op': 'delete', 'index': model.__tablename__, 'id': model.id}
+
+
+def create_backend(app):
+  """Pick the search backend for `app`, or None when search is disabled"""
+  if app.elasticsearch:
+    return ElasticsearchBackend(app.elasticsearch)
+  if app.config['SEARCH_SQLITE_PATH']:
+    return SQLiteBackend(app.config['SEARCH_SQLITE_PATH'])
+  return None
+
+
+class ElasticsearchBackend(object):
+  def __init__(self, client):
+    self.client = client
+
+  def bulk(self, actions):
+    """Send `actions` in one bulk request. Returns `(action, status, error)` for every failed action."""
+    body = []
+    for action in actions:
+      meta = {'_index': action['index'], '_type': action['index'], '_id': action['id']}
+      body.append({action['op']: meta})
+      if action['op'] == 'index':
+        body.append(action['body'])
+    response = self.client.bulk(body=body)
+    if not response.get('errors'):
+      return []
+    failed = []
+    for action, item in zip(actions, response['items']):
+      result = item[action['op']]
+      status = result.get('status', 500)
+      # deleting a document that was never indexed is fine
+      if status >= 300 and not (action['op'] == 'delete' and status == 404):
+        failed.append((action, status, result.get('error')))
+    return failed
+
+  def query(self, index, query, page, per_page):
+    search = self.client.search(
+      index=index,
+      doc_type=index,
+      body={'query': {'multi_match': {'query': query, 'fields': ['*']}},'from': (page - 1) * per_page, 'size': per_page}
+      )
+    ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    total = search['hits']['total']
+    # ES 7 reports {'value': n, 'relation': 'eq'}, earlier versions a plain int
+    return ids, total['value'] if isinstance(total, dict) else total
+
+
+class SQLiteBackend(object):
+  """Embedded full-text engine on SQLite FTS5, ranked with BM25.
+
+  Each index is an FTS5 table keyed by rowid = document id, holding the
+  searchable fields as one text column, stemmed with the Porter stemmer. Like
+  `multi_match`, a document matches if it contains any of the query terms;
+  more matches rank higher.
+  """
+
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.tables = set()
+    self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    if path != ':memory:':
+      self.conn.execute('PRAGMA journal_mode=WAL')
+
+  def _table(self, index):
+    if not re.match(r'^\w+$', index):
+      raise ValueError('invalid index name {!r}'.format(index))
+    if index not in self.tables:
+      self.conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "{}" USING fts5(doc, tokenize="porter unicode61")'.format(index))
+      self.tables.add(index)
+    return index
+
+  def bulk(self, actions):
+    with self.lock:
+      self.conn.execute('BEGIN')
+      try:
+        for action in actions:
+          table = self._table(action['index'])
+          self.conn.execute('DELETE FROM "{}" WHERE rowid = ?'.format(table), (action['id'],))
+          if action['op'] == 'index':
+            doc = ' '.join(str(value) for value in action['body'].values() if value is not None)
+            self.conn.execute('INSERT INTO "{}" (rowid, doc) VALUES (?, ?)'.format(table), (action['id'], doc))
+        self.conn.execute('COMMIT')
+      except Exception:
+        self.conn.execute('ROLLBACK')
+        raise
+    return []
+
+  def query(self, index, query, page, per_page):
+    terms = re.findall(r'\w+', query)
+    if not terms:
+      return [], 0
+    match = ' OR '.join('"{}"'.format(term) for term in terms)
+    with self.lock:
+      table = self._table(index)
+      total = self.conn.execute('SELECT count(*) FROM "{0}" WHERE "{0}" MATCH ?'.format(table), (match,)).fetchone()[0]
+      rows = self.conn.execute('SELECT rowid FROM "{0}" WHERE "{0}" MATCH ? ORDER BY bm25("{0}") LIMIT ? OFFSET ?'.format(table),
+        (match, per_page, (page - 1) * per_page)).fetchall()
+    return [row[0] for row in rows], total
+
+
+class _IndexerState(object):
+  def __init__(self, indexer, app):
+    self.indexer = indexer
+    self.app = app
+    self.queue = queue.Queue()
+    self.thread = None
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+
+
+class SearchIndexer(object):
+  """Keep search index updates off the request path.
+
+  Changes are queued after the database commit and drained by a background
+  worker that groups them into bulk requests of up to SEARCH_BATCH_SIZE
+  actions. Failed actions are retried with exponential backoff and end up in
+  the dead-letter log once SEARCH_MAX_RETRIES is exhausted or the failure is
+  not retriable. With SEARCH_INDEX_ASYNC off, batches are sent inline.
+
+  The worker only holds its app's state weakly, so an app dropped without
+  `close` (a test's, say) takes its worker with it.
+  """
+
+  def __init__(self, app=None):
+    self._states = weakref.WeakSet()
+    atexit.register(self.shutdown)
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('SEARCH_INDEX_ASYNC', True)
+    app.config.setdefault('SEARCH_BATCH_SIZE', 500)
+    app.config.setdefault('SEARCH_MAX_RETRIES', 5)
+    app.config.setdefault('SEARCH_RETRY_BACKOFF', 0.5)
+    app.config.setdefault('SEARCH_DEADLETTER_LOG', None)
+    state = _IndexerState(self, app)
+    app.extensions['search_indexer'] = state
+    self._states.add(state)
+
+  def enqueue(self, actions):
+    state = current_app.extensions['search_indexer']
+    if not state.app.search_backend or not actions:
+      return
+    if not state.app.config['SEARCH_INDEX_ASYNC']:
+      self._send(state, list(actions))
+      return
+    for action in actions:
+      state.queue.put(action)
+    with state.lock:
+      if state.thread is None and not state.stopped.is_set():
+        state.thread = threading.Thread(target=self._run, name='search-indexer', daemon=True,
+          args=(weakref.ref(state), state.queue, state.stopped, state.app.config['SEARCH_BATCH_SIZE']))
+        state.thread.start()
+        weakref.finalize(state, state.stopped.set)
+
+  def join(self):
+    """Block until every queued action has been sent or dead-lettered"""
+    current_app.extensions['search_indexer'].queue.join()
+
+  def close(self, timeout=5):
+    """Send what the current app has queued and stop its worker"""
+    state = current_app.extensions['search_indexer']
+    self._stop(state, timeout)
+    self._states.discard(state)
+
+  def shutdown(self, timeout=5):
+    for state in list(self._states):
+      self._stop(state, timeout)
+
+  def _stop(self, state, timeout):
+    state.stopped.set()
+    if state.thread is not None:
+      state.thread.join(timeout)
+
+  def _run(self, ref, actions, stopped, batch_size):
+    while True:
+      try:
+        batch = [actions.get(timeout=0.5)]
+      except queue.Empty:
+        if stopped.is_set() or ref() is None:
+          return
+        continue
+      while len(batch) < batch_size:
+        try:
+          batch.append(actions.get_nowait())
+        except queue.Empty:
+          break
+      state = ref()
+      try:
+        if state is not None:
+          self._send(state, batch)
+      except Exception:
+        state.app.logger.exception('Search indexer failed on a batch of %d actions', len(batch))
+      finally:
+        for _ in batch:
+          actions.task_done()
+        del state
+
+  def _send(self, state, actions):
+    """Send `actions` with retries. Returns the number of actions dead-lettered."""
+    config = state.app.config
+    pending, attempt, dropped = actions, 0, 0
+    while pending:
+      try:
+        failed = state.app.search_backend.bulk(pending)
+      except Exception as e:
+        # transport failure: the whole batch is retried
+        failed = [(action, None, repr(e)) for action in pending]
+      retriable, fatal = [], []
+      for f in failed:
+        (retriable if f[1] is None or f[1] == 429 or f[1] >= 500 else fatal).append(f)
+      self._dead_letter(state, fatal)
+      dropped += len(fatal)
+      pending = [f[0] for f in retriable]
+      if not pending:
+        break
+      if attempt >= config['SEARCH_MAX_RETRIES']:
+        self._dead_letter(state, retriable)
+        dropped += len(retriable)
+        break
+      # wait, but let shutdown cut the backoff short
+      state.stopped.wait(config['SEARCH_RETRY_BACKOFF'] * 2 ** attempt)
+      attempt += 1
+    return dropped
+
+  def _dead_letter(self, state, failed):
+    if not failed:
+      return
+    lines = [json.dumps({'action': action, 'status': status, 'error': error}, default=str)
+      for action, status, error in failed]
+    state.app.logger.error('Search indexer dropped %d actions', len(lines))
+    path = state.app.config['SEARCH_DEADLETTER_LOG']
+    if path:
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+      with open(path, 'a') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def bulk_reindex(index, chunks, workers=4, checkpoint=None, report=None):
+  """Send a full index rebuild through a pool of parallel bulk workers.
+
+  `chunks(after)` must yield `(last_id, actions)` in ascending id order,
+  starting after `after`. Chunks are acknowledged in order, and after each one
+  the highest fully indexed id is written to the `checkpoint` file, so an
+  interrupted run picks up where it stopped. `report(stats)` is called after
+  every chunk. Returns the final stats.
+  """
+  after = 0
+  if checkpoint and os.path.exists(checkpoint):
+    with open(checkpoint) as f:
+      saved = json.load(f)
+    if saved.get('index') == index:
+      after = saved['last_id']
+  stats = {'index': index, 'resumed_from': after, 'last_id': after, 'indexed': 0, 'failed': 0, 'seconds': 0.0, 'rate': 0.0}
+  if not current_app.search_backend:
+    return stats
+  state = current_app.extensions['search_indexer']
+  started = time()
+
+  def acknowledge(last_id, future, size):
+    stats['failed'] += future.result()
+    stats['indexed'] += size
+    stats['last_id'] = last_id
+    stats['seconds'] = time() - started
+    stats['rate'] = stats['indexed'] / stats['seconds'] if stats['seconds'] else 0.0
+    if checkpoint:
+      with open(checkpoint, 'w') as f:
+        json.dump({'index': index, 'last_id': last_id}, f)
+    if report:
+      report(stats)
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    # keep at most two chunks per worker in memory
+    inflight = deque()
+    for last_id, actions in chunks(after):
+      inflight.append((last_id, pool.submit(state.indexer._send, state, actions), len(actions)))
+      while len(inflight) >= workers * 2:
+        acknowledge(*inflight.popleft())
+    while inflight:
+      acknowledge(*inflight.popleft())
+  if checkpoint and os.path.exists(checkpoint):
+    os.remove(checkpoint)
+  return stats
@@ -0,0 +1,130 @@
+"""
+Synthetic dataset generator
+
+Fills the database with `users`, a follow graph, `posts` and `messages` through
+bulk INSERTs, then derives what the ORM would have kept up to date on the way:
+the denormalized counters, `fanout_on_read` and the materialized timeline.
+
+The graph is power-law shaped like a real one: how many accounts a user
+follows is drawn from a Pareto distribution, and who gets followed follows
+Zipf's law over the users, so a few accounts are followed by most. Who posts
+and sends messages follows Zipf's law too, over an independent ranking, so
+the busiest writers are not all also the most followed. Every user's password is
+`password`. Posts are not indexed for search; run `flask search reindex`
+afterwards.
+"""
+
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+from flask import current_app
+from app import db, hasher
+from app.models import User, Post, Message, followers, timeline
+
+WORDS = ('the a my this that some every new old good bad great little big first last long own other right '
+  'day time year people way thing world life hand part child eye place work week case point number group '
+  'coffee code music rain city train book movie game dog cat garden story idea plan question answer '
+  'love hate like want need see read write make take find think know feel try leave call keep').split()
+
+
+class Sampler(object):
+  """Draws user indexes with Zipf weights, index 0 being the most popular"""
+
+  def __init__(self, rng, n, exponent):
+    self.rng = rng
+    self.cumulative = list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+  def __call__(self):
+    return bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+def chunked(rows, size):
+  for i in range(0, len(rows), size):
+    yield rows[i:i + size]
+
+
+def generate(users, posts, messages, follows=20, exponent=1.1, days=30, seed=None, chunk_size=5000, report=None):
+  """Generate the dataset. `follows` is the mean number of accounts a user follows.
+  `report(stage, count)` is called as each stage finishes. Returns the row counts."""
+  rng = random.Random(seed)
+  now = datetime.utcnow()
+  popular = Sampler(rng, users, exponent)
+  password_hash = hasher.hash('password')
+  counts = {}
+
+  def insert(table, rows, stage):
+    for chunk in chunked(rows, chunk_size):
+      db.session.execute(table.insert(), chunk)
+    db.session.commit()
+    counts[stage] = len(rows)
+    if report:
+      report(stage, len(rows))
+
+  def moment():
+    return now - timedelta(seconds=rng.random() * days * 86400)
+
+  last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+  insert(User.__table__, [{
+    'username': 'user{}'.format(last_id + 1 + i),
+    'email': 'user{}@example.com'.format(last_id + 1 + i),
+    'password_hash': password_hash,
+    'about_me': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+    'last_seen': moment(),
+  } for i in range(users)], 'users')
+  ids = [id for id, in db.session.query(User.id).filter(User.id > last_id).order_by(User.id)]
+
+  edges = []
+  # Pareto with shape 2 has mean 2 * scale, so scale follows / 2 for the requested mean
+  for follower in ids:
+    wanted = min(int(rng.paretovariate(2) * follows / 2), users - 1)
+    followed = set()
+    # the tail is rarely drawn; give up on a full set rather than loop for it
+    for _ in range(wanted * 20):
+      if len(followed) >= wanted:
+        break
+      target = ids[popular()]
+      if target != follower:
+        followed.add(target)
+    edges.extend({'follower_id': follower, 'followed_id': target} for target in followed)
+  insert(followers, edges, 'follows')
+
+  writers = list(ids)
+  rng.shuffle(writers)
+  insert(Post.__table__, [{
+    'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 20)))[:140],
+    'timestamp': moment(),
+    'user_id': writers[popular()],
+  } for _ in range(posts)], 'posts')
+
+  rows = []
+  for _ in range(messages):
+    sender, recipient = writers[popular()], ids[rng.randrange(users)]
+    rows.append({
+      'sender_id': sender,
+      'recipient_id': recipient,
+      'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 20)))[:140],
+      'timestamp': moment(),
+    })
+  insert(Message.__table__, rows, 'messages')
+
+  derive(last_id)
+  if report:
+    report('derived', users)
+  return counts
+
+
+def derive(after):
+  """Bring the counters, `fanout_on_read` and timelines of the users with ids
+  above `after` in line with the bulk-inserted rows, which only ever reference them"""
+  User.reconcile_counters(after=after)
+  db.session.execute(User.__table__.update().where(User.id > after).values(
+    fanout_on_read=User.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']))
+  insert_timeline = lambda select: db.session.execute(
+    timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], select))
+  # every author sees their own posts, followers only those of authors still pushed to
+  insert_timeline(db.select([Post.user_id, Post.id, Post.timestamp]).where(Post.user_id > after))
+  pushed = db.select([User.id]).where(db.and_(User.id > after, User.fanout_on_read.is_(False)))
+  insert_timeline(db.select([followers.c.follower_id, Post.id, Post.timestamp]).select_from(
+    Post.__table__.join(followers, followers.c.followed_id == Post.user_id)).where(Post.user_id.in_(pushed)))
+  db.session.commit()
@@ -0,0 +1,114 @@
+"""
+Write-behind buffer for `User.last_seen`
+
+Every authenticated request refreshes `last_seen`. Committing that on each page
+view costs a write transaction per request (and under SQLite blocks readers
+behind the writer lock), so updates are coalesced per user in memory and
+written with a single bulk UPDATE once the buffer is `LAST_SEEN_FLUSH_SIZE`
+users large or `LAST_SEEN_FLUSH_INTERVAL` seconds old, whichever comes first.
+Whatever is still pending is flushed when the process exits, or when
+`close` is called for an app that is going away.
+
+The flusher thread only holds the app's buffer weakly, so an app that is
+dropped without `close` (a test's, say) takes its thread with it.
+"""
+
+import atexit
+import threading
+import weakref
+from datetime import datetime
+from time import time
+from sqlalchemy.orm.attributes import set_committed_value
+from flask import current_app
+
+
+class _BufferState(object):
+  def __init__(self, app, db):
+    self.app = app
+    self.db = db
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.last_flush = time()
+    self.thread = None
+    self.stopped = threading.Event()
+
+
+class LastSeenBuffer(object):
+  """Flask extension coalescing `last_seen` writes. One buffer per app."""
+
+  def __init__(self, app=None, db=None):
+    self._states = weakref.WeakSet()
+    atexit.register(self.shutdown)
+    if app is not None:
+      self.init_app(app, db)
+
+  def init_app(self, app, db):
+    app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 60)
+    app.config.setdefault('LAST_SEEN_FLUSH_SIZE', 500)
+    state = _BufferState(app, db)
+    app.extensions['last_seen'] = state
+    self._states.add(state)
+
+  def touch(self, user, when=None):
+    """Record that `user` was seen now, without dirtying the session"""
+    when = when or datetime.utcnow()
+    # keep the loaded instance current for the rest of the request
+    set_committed_value(user, 'last_seen', when)
+    state = current_app.extensions['last_seen']
+    config = state.app.config
+    with state.lock:
+      state.pending[user.id] = when
+      due = (len(state.pending) >= config['LAST_SEEN_FLUSH_SIZE'] or
+             time() - state.last_flush >= config['LAST_SEEN_FLUSH_INTERVAL'])
+      if state.thread is None and config['LAST_SEEN_FLUSH_INTERVAL'] > 0 and not state.stopped.is_set():
+        state.thread = threading.Thread(target=self._run, name='last-seen-flusher', daemon=True,
+          args=(weakref.ref(state), state.stopped, config['LAST_SEEN_FLUSH_INTERVAL']))
+        state.thread.start()
+        weakref.finalize(state, state.stopped.set)
+    if due:
+      self._flush(state)
+
+  def flush(self):
+    """Write the pending updates of the current app. Returns the number of users written."""
+    return self._flush(current_app.extensions['last_seen'])
+
+  def close(self):
+    """Flush the current app's buffer and stop its flusher thread"""
+    state = current_app.extensions['last_seen']
+    self._stop(state)
+    self._states.discard(state)
+
+  def shutdown(self):
+    for state in list(self._states):
+      self._stop(state)
+
+  def _stop(self, state):
+    state.stopped.set()
+    if state.thread is not None:
+      state.thread.join()
+    self._flush(state)
+
+  def _run(self, ref, stopped, interval):
+    while not stopped.wait(interval):
+      state = ref()
+      if state is None:
+        return
+      self._flush(state)
+      del state
+
+  def _flush(self, state):
+    with state.lock:
+      pending, state.pending = state.pending, {}
+      state.last_flush = time()
+    if not pending:
+      return 0
+    from app.models import User
+    db = state.db
+    stmt = User.__table__.update().where(User.id == db.bindparam('_id')).values(last_seen=db.bindparam('_seen'))
+    try:
+      with db.get_engine(state.app).begin() as conn:
+        conn.execute(stmt, [{'_id': id, '_seen': seen} for id, seen in pending.items()])
+    except Exception:
+      state.app.logger.exception('Could not write last_seen for %d users', len(pending))
+      return 0
+    return len(pending)
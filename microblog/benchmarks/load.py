@@ -0,0 +1,210 @@
+"""
+End-to-end load benchmark
+
+Requests the main pages as a sample of signed-in users and reports latency
+percentiles and database statements per request for each endpoint. Runs
+against the database in DATABASE_URL, typically one filled by
+`flask generate`:
+
+  flask generate --users 5000 --posts 100000 --seed 1
+  python benchmarks/load.py --requests 200 --output before.json
+  python benchmarks/load.py --requests 200 --output after.json --compare before.json
+
+Requests go through the Flask test client by default, or with --server
+through a local HTTP server on a free port, which adds the WSGI server and
+socket round trip to every measurement. Requests are sent one at a time so
+that statements can be attributed to the request that issued them.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+from app import create_app, db, last_seen
+from app.models import User, Post, Message, followers
+from config import Config
+
+ENDPOINTS = [
+  ('index', '/index'),
+  ('explore', '/explore'),
+  ('user', '/user/{target}'),
+  ('popup', '/user/{target}/popup'),
+  ('cards', '/users/cards?u={target}'),
+  ('messages', '/messages'),
+  ('notifications', '/notifications'),
+]
+
+
+def percentile(values, p):
+  """Nearest-rank percentile of sorted `values`"""
+  return values[max(int(round(p / 100.0 * len(values))) - 1, 0)]
+
+
+class TestClientDriver(object):
+  def __init__(self, app):
+    self.app = app
+    self.clients = {}
+
+  def get(self, user, url):
+    client = self.clients.get(user.id)
+    if client is None:
+      client = self.clients[user.id] = self.app.test_client()
+      with client.session_transaction() as session:
+        session['user_id'] = str(user.id)
+    response = client.get(url)
+    response.get_data()
+    return response.status_code
+
+  def close(self):
+    pass
+
+
+class QuietHandler(WSGIRequestHandler):
+  def log_request(self, *args):
+    pass
+
+
+class ServerDriver(object):
+  def __init__(self, app):
+    self.app = app
+    self.server = make_server('127.0.0.1', 0, app, threaded=False, request_handler=QuietHandler)
+    self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.serializer = app.session_interface.get_signing_serializer(app)
+
+  def get(self, user, url):
+    cookie = '{}={}'.format(self.app.session_cookie_name, self.serializer.dumps({'user_id': str(user.id), '_fresh': True}))
+    request = urllib.request.Request(self.base + url, headers={'Cookie': cookie})
+    try:
+      with urllib.request.urlopen(request) as response:
+        response.read()
+        return response.status
+    except urllib.error.HTTPError as e:
+      return e.code
+
+  def close(self):
+    self.server.shutdown()
+
+
+def dataset():
+  return {
+    'users': User.query.count(),
+    'follows': db.session.query(db.func.count()).select_from(followers).scalar(),
+    'posts': Post.query.count(),
+    'messages': Message.query.count(),
+  }
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(app, requests, sample, warmup, server, seed):
+  rng = random.Random(seed)
+  statements = [0]
+  count = lambda *args: statements.__setitem__(0, statements[0] + 1)
+
+  with app.app_context():
+    # half the sample are the most followed accounts, whose pages are the heaviest
+    top = User.query.order_by(User.followers_count.desc()).limit(sample // 2).all()
+    others = User.query.order_by(db.func.random()).limit(sample - len(top)).all()
+    users = top + others
+    if not users:
+      raise SystemExit('The database has no users; run `flask generate` first.')
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    info = dataset()
+
+  driver = ServerDriver(app) if server else TestClientDriver(app)
+  results = {}
+  try:
+    for name, pattern in ENDPOINTS:
+      latencies, queries, errors = [], [], 0
+      for i in range(warmup + requests):
+        user, target = rng.choice(users), rng.choice(users)
+        url = pattern.format(target=target.username)
+        before = statements[0]
+        started = perf_counter()
+        status = driver.get(user, url)
+        elapsed = perf_counter() - started
+        if i < warmup:
+          continue
+        latencies.append(elapsed * 1000)
+        queries.append(statements[0] - before)
+        errors += status >= 400
+      latencies.sort()
+      results[name] = {
+        'requests': requests,
+        'errors': errors,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'queries_per_request': sum(queries) / len(queries),
+        'max_queries': max(queries),
+      }
+  finally:
+    driver.close()
+    with app.app_context():
+      db.event.remove(db.engine, 'before_cursor_execute', count)
+      last_seen.flush()
+
+  return {
+    'started': datetime.utcnow().isoformat(),
+    'revision': git_revision(),
+    'mode': 'server' if server else 'test-client',
+    'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+    'dataset': info,
+    'endpoints': results,
+  }
+
+
+def report(results, baseline=None):
+  columns = ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+  print('{:<14}'.format('endpoint') + ''.join('{:>22}'.format(c) for c in columns) + '{:>8}'.format('errors'))
+  for name, stats in results['endpoints'].items():
+    cells = []
+    for column in columns:
+      cell = '{:.1f}'.format(stats[column])
+      old = baseline and baseline['endpoints'].get(name, {}).get(column)
+      if old:
+        cell += ' ({:+.0f}%)'.format((stats[column] - old) / old * 100)
+      cells.append('{:>22}'.format(cell))
+    print('{:<14}'.format(name) + ''.join(cells) + '{:>8}'.format(stats['errors']))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--requests', type=int, default=100, help='measured requests per endpoint')
+  parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint, sent first')
+  parser.add_argument('--sample', type=int, default=50, help='signed-in users to spread requests over')
+  parser.add_argument('--server', action='store_true', help='go through a local HTTP server instead of the test client')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--compare', help='JSON results of an earlier run to show changes against')
+  args = parser.parse_args()
+
+  app = create_app(Config)
+  results = run(app, args.requests, args.sample, args.warmup, args.server, args.seed)
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print('{mode} against {database}: {dataset}'.format(**results))
+  report(results, baseline)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,101 @@
+"""
+Logins per second at different password hashing pool sizes
+
+Signs in from a number of concurrent client threads against an in-process app
+and reports the throughput and latency for each PASSWORD_HASH_WORKERS value.
+Pool size 0 hashes on the request threads, as before the hashing pool.
+
+  python benchmarks/login_throughput.py --pools 0 1 2 4 --clients 16 --logins 200
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, hasher, last_seen
+from app.models import User
+from config import Config
+
+
+class BenchmarkConfig(Config):
+  WTF_CSRF_ENABLED = False
+  SEARCH_SQLITE_PATH = None
+  ELASTICSEARCH_URL = None
+
+
+def run(workers, clients, logins, iterations, users=20):
+  path = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+
+  class PoolConfig(BenchmarkConfig):
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    PASSWORD_HASH_WORKERS = workers
+    PASSWORD_HASH_ITERATIONS = iterations
+    PASSWORD_HASH_MAX_PENDING = clients
+
+  app = create_app(PoolConfig)
+  with app.app_context():
+    db.create_all()
+    for i in range(users):
+      u = User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+      u.set_password('secret')
+      db.session.add(u)
+    db.session.commit()
+
+  latencies, errors = [], []
+  remaining = iter(range(logins))
+  lock = threading.Lock()
+
+  def client():
+    c = app.test_client()
+    while True:
+      with lock:
+        i = next(remaining, None)
+      if i is None:
+        return
+      started = perf_counter()
+      response = c.post('/auth/login', data={'username': 'user{}'.format(i % users), 'password': 'secret'})
+      with lock:
+        latencies.append(perf_counter() - started)
+        if response.status_code != 302:
+          errors.append(response.status_code)
+      c.get('/auth/logout')
+
+  threads = [threading.Thread(target=client) for _ in range(clients)]
+  started = perf_counter()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = perf_counter() - started
+
+  with app.app_context():
+    last_seen.flush()
+    hasher.shutdown()
+    db.session.remove()
+  os.remove(path)
+  latencies.sort()
+  return {
+    'workers': workers,
+    'logins/s': logins / elapsed,
+    'p50 ms': latencies[len(latencies) // 2] * 1000,
+    'p99 ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    'errors': len(errors),
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--pools', type=int, nargs='+', default=[0, 1, 2, 4])
+  parser.add_argument('--clients', type=int, default=16)
+  parser.add_argument('--logins', type=int, default=200)
+  parser.add_argument('--iterations', type=int, default=BenchmarkConfig.PASSWORD_HASH_ITERATIONS)
+  args = parser.parse_args()
+  print('{:>8} {:>10} {:>10} {:>10} {:>7}'.format('workers', 'logins/s', 'p50 ms', 'p99 ms', 'errors'))
+  for workers in args.pools:
+    r = run(workers, args.clients, args.logins, args.iterations)
+    print('{workers:>8} {logins/s:>10.1f} {p50 ms:>10.1f} {p99 ms:>10.1f} {errors:>7}'.format(**r))
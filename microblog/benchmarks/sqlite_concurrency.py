@@ -0,0 +1,129 @@
+"""
+Concurrent read/write throughput on SQLite, before and after engine tuning
+
+Runs reader threads (a user lookup and the newest posts, as the list pages do)
+against writer threads (a `last_seen` style bulk UPDATE and a new post per
+commit) on a fresh database file for a fixed time, once with the old engine
+setup (rollback journal, full fsync, a new connection per checkout) and once
+with the defaults from `Config` (WAL, synchronous=NORMAL, memory map, page
+cache and a connection pool), and reports operations per second and lock
+errors for each.
+
+  python benchmarks/sqlite_concurrency.py --readers 8 --writers 2 --seconds 10
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+class BenchmarkConfig(Config):
+  SEARCH_SQLITE_PATH = None
+  ELASTICSEARCH_URL = None
+  LAST_SEEN_FLUSH_INTERVAL = 0
+
+
+class RollbackJournalConfig(BenchmarkConfig):
+  """The engine as it was before: nothing tuned"""
+  DATABASE_POOL_SIZE = 0
+  SQLITE_JOURNAL_MODE = 'delete'
+  SQLITE_SYNCHRONOUS = 'full'
+  SQLITE_MMAP_SIZE = None
+  SQLITE_CACHE_SIZE = None
+  SQLITE_BUSY_TIMEOUT = None
+
+
+def run(config_class, readers, writers, seconds, users=1000, posts=5000):
+  directory = tempfile.mkdtemp()
+
+  class RunConfig(config_class):
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+
+  app = create_app(RunConfig)
+  with app.app_context():
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+      {'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(users)])
+    db.session.execute(Post.__table__.insert(), [
+      {'body': 'post', 'user_id': random.randrange(users) + 1, 'timestamp': datetime.utcnow()} for _ in range(posts)])
+    db.session.commit()
+
+  counts = {'reads': 0, 'writes': 0, 'errors': 0}
+  lock = threading.Lock()
+  stop = threading.Event()
+
+  def count(key):
+    with lock:
+      counts[key] += 1
+
+  def reader():
+    with app.app_context():
+      while not stop.is_set():
+        try:
+          User.query.get(random.randrange(users) + 1)
+          Post.query.order_by(Post.timestamp.desc()).limit(20).all()
+          count('reads')
+        except OperationalError:
+          count('errors')
+        db.session.remove()
+
+  def writer():
+    stmt = User.__table__.update().where(User.id == db.bindparam('_id')).values(last_seen=db.bindparam('_seen'))
+    with app.app_context():
+      while not stop.is_set():
+        try:
+          with db.engine.begin() as conn:
+            conn.execute(stmt, [{'_id': random.randrange(users) + 1, '_seen': datetime.utcnow()} for _ in range(50)])
+          db.session.add(Post(body='post', author=User.query.get(random.randrange(users) + 1)))
+          db.session.commit()
+          count('writes')
+        except OperationalError:
+          db.session.rollback()
+          count('errors')
+        db.session.remove()
+
+  threads = [threading.Thread(target=reader) for _ in range(readers)]
+  threads += [threading.Thread(target=writer) for _ in range(writers)]
+  started = perf_counter()
+  for t in threads:
+    t.start()
+  stop.wait(seconds)
+  stop.set()
+  for t in threads:
+    t.join()
+  elapsed = perf_counter() - started
+
+  with app.app_context():
+    db.session.remove()
+    db.engine.dispose()
+  shutil.rmtree(directory)
+  return {
+    'reads/s': counts['reads'] / elapsed,
+    'writes/s': counts['writes'] / elapsed,
+    'errors': counts['errors'],
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--readers', type=int, default=8)
+  parser.add_argument('--writers', type=int, default=2)
+  parser.add_argument('--seconds', type=float, default=10)
+  args = parser.parse_args()
+  print('{:>18} {:>10} {:>10} {:>7}'.format('engine', 'reads/s', 'writes/s', 'errors'))
+  for name, config_class in (('rollback journal', RollbackJournalConfig), ('tuned (WAL)', BenchmarkConfig)):
+    r = run(config_class, args.readers, args.writers, args.seconds)
+    print('{:>18} {reads/s:>10.1f} {writes/s:>10.1f} {errors:>7}'.format(name, **r))
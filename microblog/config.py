@@ -14,12 +14,117 @@ class Config(object):
   ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
   """str: connection URL for ElasticSearch"""
 
+  SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH', os.path.join(basedir, 'search.db'))
+  """str: file for the embedded full-text index used when ELASTICSEARCH_URL is unset. Set but empty disables search."""
+
+  SEARCH_INDEX_ASYNC = os.environ.get('SEARCH_INDEX_SYNC') is None
+  """bool: send index updates from a background worker instead of the committing request."""
+
+  SEARCH_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE') or 500)
+  """int: most index/delete actions sent in one bulk request."""
+
+  SEARCH_MAX_RETRIES = int(os.environ.get('SEARCH_MAX_RETRIES') or 5)
+  """int: attempts for a failing bulk action before it is dead-lettered."""
+
+  SEARCH_RETRY_BACKOFF = float(os.environ.get('SEARCH_RETRY_BACKOFF') or 0.5)
+  """float: initial retry delay in seconds, doubled on every attempt."""
+
+  SEARCH_DEADLETTER_LOG = os.environ.get('SEARCH_DEADLETTER_LOG') or os.path.join(basedir, 'logs', 'search-deadletter.jsonl')
+  """str: file collecting index actions that could not be delivered, one JSON object per line."""
+
   LANGUAGES = ['en_US', 'es_ES']
   """list: translated languages"""
 
   POSTS_PER_PAGE = 3
   """int: pagination setting"""
 
+  PAGINATION_MODE = os.environ.get('PAGINATION_MODE') or 'keyset'
+  """str: 'keyset' for cursor pagination on list pages, 'offset' for page numbers."""
+
+  TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+  """int: follower count above which an author's posts are read on demand instead of pushed to timelines."""
+
+  TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 1000)
+  """int: number of recent posts copied into a timeline when following someone."""
+
+  FOLLOW_GRAPH_CACHE_SIZE = int(os.environ.get('FOLLOW_GRAPH_CACHE_SIZE') or 1000000)
+  """int: followed ids held in the per-process follow-graph cache, across all users."""
+
+  FOLLOW_GRAPH_CACHE_TTL = float(os.environ.get('FOLLOW_GRAPH_CACHE_TTL') or 60)
+  """float: seconds a user's followed ids are cached, the most a follow made in another process goes unseen."""
+
+  FOLLOW_GRAPH_INLINE_LIMIT = int(os.environ.get('FOLLOW_GRAPH_INLINE_LIMIT') or 500)
+  """int: largest followed set `followed_posts()` inlines as an id list instead of joining followers."""
+
+  PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+  """str: werkzeug hash method for new password hashes."""
+
+  PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or 150000)
+  """int: PBKDF2 rounds for new password hashes. Stored hashes made with other rounds are upgraded at login."""
+
+  PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+  """int: salt length for new password hashes."""
+
+  PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1)
+  """int: processes hashing and verifying passwords; 0 hashes on the request thread."""
+
+  PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 32)
+  """int: hash calls allowed to queue or run at once before logins are answered with 503."""
+
+  IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+  """int: users whose identity snapshot the login loader keeps per process; 0 disables the cache."""
+
+  IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL') or 300)
+  """float: seconds an identity snapshot is trusted before the user is loaded again."""
+
+  LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+  """float: longest time in seconds a `last_seen` update may wait in memory before it is written."""
+
+  LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 500)
+  """int: number of buffered users that triggers an immediate `last_seen` flush."""
+
+  PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE') or 64 * 1024 * 1024)
+  """int: bytes of rendered explore and profile pages kept per process; 0 keeps only the ETags working."""
+
+  PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL') or 300)
+  """float: seconds a rendered page is served from the cache at most."""
+
+  FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 16 * 1024 * 1024)
+  """int: bytes of rendered post snippets kept per process; 0 renders every post every time."""
+
+  CARD_CACHE_SIZE = int(os.environ.get('CARD_CACHE_SIZE') or 10000)
+  """int: user cards for the hover popups kept per process; 0 loads them on every request."""
+
+  CARD_CACHE_TTL = float(os.environ.get('CARD_CACHE_TTL') or 60)
+  """float: seconds a user card is served from the per-process cache."""
+
+  CARDS_MAX_BATCH = int(os.environ.get('CARDS_MAX_BATCH') or 100)
+  """int: most usernames one request to `/users/cards` may ask for."""
+
+  EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+  """int: rows an account export fetches from the database at a time."""
+
+  EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 65536)
+  """int: characters of NDJSON gathered before an export sends them on."""
+
+  PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS') is not None
+  """bool: time SQL, template rendering and before_request per request, reported in a Server-Timing header and the log."""
+
+  PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS') or 500)
+  """float: with PROFILE_REQUESTS, requests slower than this many milliseconds are logged with their SQL; 0 disables."""
+
+  NOTIFICATIONS_RETENTION_DAYS = float(os.environ.get('NOTIFICATIONS_RETENTION_DAYS') or 30)
+  """float: age in days past which `flask notifications prune` deletes a notification."""
+
+  NOTIFICATIONS_MAX_CONNECTIONS = int(os.environ.get('NOTIFICATIONS_MAX_CONNECTIONS') or 1000)
+  """int: open notification streams and long polls allowed before clients are told to retry."""
+
+  NOTIFICATIONS_HEARTBEAT = float(os.environ.get('NOTIFICATIONS_HEARTBEAT') or 15)
+  """float: seconds between keep-alive comments on an idle notification stream."""
+
+  NOTIFICATIONS_LONGPOLL_TIMEOUT = float(os.environ.get('NOTIFICATIONS_LONGPOLL_TIMEOUT') or 30)
+  """float: seconds a long poll waits for a notification before returning empty."""
+
   MAIL_SERVER = os.environ.get('MAIL_SERVER')
   """str: designated email server."""
 
@@ -38,6 +143,24 @@ class Config(object):
   MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
   """str: designated email password."""
 
+  MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+  """int: background threads sending mail, each over its own SMTP connection."""
+
+  MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+  """int: messages that may wait to be sent before senders are held back."""
+
+  MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+  """float: seconds a sender waits for room in a full mail queue before giving up with 503."""
+
+  MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+  """int: most messages sent over one SMTP connection."""
+
+  MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 5)
+  """int: reconnection attempts for a batch before its remaining messages are dropped."""
+
+  MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF') or 1)
+  """float: seconds before the first retry, doubled on each further attempt."""
+
   ADMINS = ['zachfisic@gmail.com']
   """list: email addresses for logging/error notification."""
 
@@ -47,5 +170,38 @@ class Config(object):
   SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
   """str: URI for application database."""
 
+  DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)
+  """int: connections kept open per engine, SQLite files included; 0 opens one per checkout."""
+
+  DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+  """int: connections opened beyond DATABASE_POOL_SIZE under load, closed when returned."""
+
+  DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 3600)
+  """int: seconds after which a pooled connection is replaced, to stay ahead of server idle timeouts."""
+
+  DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING') is not None
+  """bool: test every connection on checkout and reconnect if it went away."""
+
+  SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+  """str: SQLite journal mode; WAL lets readers run alongside a writer. Empty keeps the file's mode."""
+
+  SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+  """str: SQLite fsync level; NORMAL is safe from corruption under WAL. Empty keeps SQLite's default."""
+
+  SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+  """int: bytes of the SQLite file each connection reads through a memory map."""
+
+  SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64 * 1024)
+  """int: SQLite page cache per connection, in pages, or in KiB when negative."""
+
+  SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+  """int: milliseconds an SQLite connection waits for a lock before failing."""
+
+  SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+  """list: URIs of read replicas of the application database, from a comma-separated DATABASE_REPLICA_URLS. GET requests read from them."""
+
+  REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+  """float: seconds after committing a write during which that user reads from the primary, to see their own writes despite replica lag."""
+
   SQLALCHEMY_TRACK_MODIFICATIONS = False
   """bool: setting for modification tracking."""
\ No newline at end of file
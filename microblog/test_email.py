@@ -0,0 +1,163 @@
+import socketserver
+import threading
+import unittest
+from app import create_app, db, mail, mailer
+from app.auth.email import send_password_reset_email
+from app.email import send_email, MailQueueFull
+from app.models import User
+from test_user import TestConfig
+
+class DebuggingSMTPServer(socketserver.ThreadingTCPServer):
+  """A local SMTP server that keeps what it receives, and can turn connections away"""
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, refuse=0, reject=()):
+    self.connections = 0
+    self.messages = []
+    self.refuse = refuse
+    self.reject = set(reject)
+    self.lock = threading.Lock()
+    socketserver.ThreadingTCPServer.__init__(self, ('localhost', 0), SMTPHandler)
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+  def reply(self, line):
+    self.wfile.write((line + '\r\n').encode())
+
+  def handle(self):
+    server = self.server
+    with server.lock:
+      if server.refuse:
+        server.refuse -= 1
+        self.reply('421 try again later')
+        return
+      server.connections += 1
+    self.reply('220 localhost')
+    recipients = []
+    for line in self.rfile:
+      command = line.decode().strip()
+      verb = command[:4].upper()
+      if verb in ('HELO', 'EHLO'):
+        self.reply('250 localhost')
+      elif verb == 'MAIL':
+        recipients = []
+        self.reply('250 OK')
+      elif verb == 'RCPT':
+        address = command.split(':', 1)[1].strip('<> ')
+        if address in server.reject:
+          self.reply('550 no such user')
+        else:
+          recipients.append(address)
+          self.reply('250 OK')
+      elif verb == 'DATA':
+        self.reply('354 go ahead')
+        body = []
+        for data in self.rfile:
+          if data == b'.\r\n':
+            break
+          body.append(data)
+        with server.lock:
+          server.messages.append((recipients, b''.join(body).decode()))
+        self.reply('250 queued')
+      elif verb == 'RSET' or verb == 'NOOP':
+        self.reply('250 OK')
+      elif verb == 'QUIT':
+        self.reply('221 bye')
+        return
+      else:
+        self.reply('502 not implemented')
+
+class MailConfig(TestConfig):
+  MAIL_SUPPRESS_SEND = False
+  MAIL_SERVER = 'localhost'
+  MAIL_WORKERS = 1
+  MAIL_RETRY_BACKOFF = 0
+
+class MailDispatcherCase(unittest.TestCase):
+  def setUp(self):
+    self.smtp = DebuggingSMTPServer()
+    threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+    MailConfig.MAIL_PORT = self.smtp.server_address[1]
+    self.app = create_app(MailConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+
+  def tearDown(self):
+    mailer.close()
+    self.app_context.pop()
+    self.smtp.shutdown()
+    self.smtp.server_close()
+
+  def send(self, n, recipient='susan@example.com'):
+    for i in range(n):
+      send_email('hello {}'.format(i), 'admin@example.com', [recipient], 'text', '<p>html</p>')
+
+  def test_batches_over_one_connection(self):
+    self.send(10)
+    mailer.join()
+    self.assertEqual(len(self.smtp.messages), 10)
+    self.assertLess(self.smtp.connections, 10)
+
+    # closing sends what is still queued and stops the workers
+    threads = self.app.extensions['mail_dispatcher'].threads
+    self.send(2)
+    mailer.close()
+    self.assertEqual(len(self.smtp.messages), 12)
+    self.assertFalse([thread for thread in threads if thread.is_alive()])
+
+  def test_retry_and_reject(self):
+    self.smtp.refuse = 2
+    self.smtp.reject.add('nobody@example.com')
+    self.send(1, 'nobody@example.com')
+    self.send(2)
+    mailer.join()
+    # refused connections are retried, the rejected recipient is dropped without holding up the rest
+    self.assertEqual([r for r, body in self.smtp.messages], [['susan@example.com']] * 2)
+
+  def test_rejected_message_in_a_batch(self):
+    from flask_mail import Message
+    state = self.app.extensions['mail_dispatcher']
+    self.app.config['MAIL_RETRY_BACKOFF'] = 1
+    self.smtp.reject.add('nobody@example.com')
+    # queued before the worker starts, so they all go out as one batch
+    for recipient in ('susan@example.com', 'nobody@example.com', 'susan@example.com'):
+      state.queue.put(Message('hello', sender='admin@example.com', recipients=[recipient], body='text'))
+    self.send(1)
+    mailer.join()
+    # a 550 is not worth a retry: one connection, and the good messages arrive
+    self.assertEqual([r for r, body in self.smtp.messages], [['susan@example.com']] * 3)
+    self.assertEqual(self.smtp.connections, 1)
+
+  def test_full_queue_pushes_back(self):
+    state = self.app.extensions['mail_dispatcher']
+    self.app.config['MAIL_QUEUE_TIMEOUT'] = 0.01
+    for i in range(state.queue.maxsize):
+      state.queue.put(None)
+    with self.assertRaises(MailQueueFull):
+      self.send(1)
+    while not state.queue.empty():
+      state.queue.get_nowait()
+
+class PasswordResetMailCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(TestConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_reset_mail_is_queued(self):
+    u = User(username='susan', email='susan@example.com')
+    db.session.add(u)
+    db.session.commit()
+    with mail.record_messages() as outbox, self.app.test_request_context():
+      send_password_reset_email(u)
+      mailer.join()
+    self.assertEqual([m.recipients for m in outbox], [['susan@example.com']])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,102 @@
+import json
+import unittest
+from time import time
+from app import create_app, db, hub
+from app.models import User, Notification
+from test_user import TestConfig
+
+class NotificationConfig(TestConfig):
+  LAST_SEEN_FLUSH_INTERVAL = 0
+  NOTIFICATIONS_HEARTBEAT = 0.05
+  NOTIFICATIONS_LONGPOLL_TIMEOUT = 0.05
+
+class NotificationHubCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(NotificationConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    self.user = User(username='john', email='john@example.com')
+    db.session.add(self.user)
+    db.session.commit()
+    self.client = self.app.test_client()
+    with self.client.session_transaction() as session:
+      session['user_id'] = str(self.user.id)
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_publish_after_commit(self):
+    sub = hub.subscribe(self.user.id)
+    self.user.add_notification('unread_message_count', 3)
+    self.assertIsNone(sub.get(timeout=0))
+    db.session.commit()
+    event = sub.get(timeout=0)
+    self.assertEqual((event['name'], event['data']), ('unread_message_count', 3))
+
+    # rolled back notifications are never delivered
+    self.user.add_notification('unread_message_count', 4)
+    db.session.rollback()
+    db.session.commit()
+    self.assertIsNone(sub.get(timeout=0))
+    hub.unsubscribe(sub)
+    self.assertEqual(hub.connections, 0)
+
+  def test_upsert_and_prune(self):
+    for count in (1, 2, 3):
+      self.user.add_notification('unread_message_count', count)
+      db.session.commit()
+    self.user.add_notification('task_progress', 50)
+    db.session.commit()
+    # one row per name, holding the latest payload
+    self.assertEqual(Notification.query.count(), 2)
+    events = json.loads(self.client.get('/notifications?since=0').get_data(as_text=True))
+    self.assertEqual([(e['name'], e['data']) for e in events], [('unread_message_count', 3), ('task_progress', 50)])
+
+    cutoff = events[0]['timestamp'] + 1e-6
+    self.assertEqual(Notification.prune(cutoff, batch_size=1), 1)
+    self.assertEqual([n.name for n in Notification.query], ['task_progress'])
+
+  def test_long_poll(self):
+    self.user.add_notification('unread_message_count', 1)
+    db.session.commit()
+    events = json.loads(self.client.get('/notifications/poll?since=0').get_data(as_text=True))
+    self.assertEqual([e['data'] for e in events], [1])
+
+    # nothing newer: the poll waits out its timeout and returns empty
+    since = events[-1]['timestamp']
+    events = json.loads(self.client.get('/notifications/poll?since={}'.format(since)).get_data(as_text=True))
+    self.assertEqual(events, [])
+
+  def test_catch_up_sees_other_processes(self):
+    self.user.add_notification('unread_message_count', 1)
+    db.session.commit()
+    # written by another process: in the database, never published to this hub
+    Notification.upsert(self.user.id, 'task_progress', json.dumps(40), time() + 1)
+    db.session.commit()
+    events = json.loads(self.client.get('/notifications/poll?since=0').get_data(as_text=True))
+    self.assertEqual([(e['name'], e['data']) for e in events], [('unread_message_count', 1), ('task_progress', 40)])
+
+  def test_stream(self):
+    self.user.add_notification('unread_message_count', 2)
+    db.session.commit()
+    response = self.client.get('/notifications/stream', buffered=False)
+    self.assertEqual(response.mimetype, 'text/event-stream')
+    chunks = iter(response.response)
+    self.assertTrue(next(chunks).startswith(b'retry:'))
+    event = next(chunks).decode('utf-8')
+    self.assertEqual(json.loads(event.split('data: ')[1])['data'], 2)
+    self.assertEqual(next(chunks), b': heartbeat\n\n')
+    response.close()
+    self.assertEqual(hub.connections, 0)
+
+  def test_max_connections(self):
+    self.app.config['NOTIFICATIONS_MAX_CONNECTIONS'] = 0
+    response = self.client.get('/notifications/poll')
+    self.assertEqual(response.status_code, 503)
+    self.assertIn('Retry-After', response.headers)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import unittest
+from app import create_app, db
+from app.models import User, Post
+from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+from test_user import TestConfig
+
+class KeysetPaginationCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(TestConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_cursor_roundtrip(self):
+    now = datetime.utcnow()
+    token = encode_cursor([now, 42], 'n')
+    self.assertEqual(decode_cursor(token), ([now, 42], 'n'))
+    with self.assertRaises(ValueError):
+      decode_cursor('not-a-cursor')
+
+  def test_walk_followed_posts(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    # two posts share a timestamp so the id tie-breaker matters
+    now = datetime.utcnow()
+    posts = [Post(body=str(i), author=(u1, u2)[i % 2], timestamp=now + timedelta(seconds=i // 2)) for i in range(5)]
+    db.session.add_all(posts)
+    db.session.commit()
+    expected = u1.followed_posts().order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).all()
+    keys = (Post.timestamp, Post.id)
+
+    with self.app.test_request_context():
+      first = keyset_paginate(u1.followed_posts(), keys, None, 2)
+      self.assertFalse(first.has_prev)
+      second = keyset_paginate(u1.followed_posts(), keys, first.next_args['cursor'], 2)
+      third = keyset_paginate(u1.followed_posts(), keys, second.next_args['cursor'], 2)
+      self.assertEqual(first.items + second.items + third.items, expected)
+      self.assertFalse(third.has_next)
+
+      # walking back returns the same pages
+      back = keyset_paginate(u1.followed_posts(), keys, third.prev_args['cursor'], 2)
+      self.assertEqual(back.items, second.items)
+      back = keyset_paginate(u1.followed_posts(), keys, back.prev_args['cursor'], 2)
+      self.assertEqual(back.items, first.items)
+      self.assertFalse(back.has_prev)
+
+  def test_walk_timeline(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    now = datetime.utcnow()
+    posts = [Post(body=str(i), author=(u1, u2)[i % 2], timestamp=now + timedelta(seconds=i // 2)) for i in range(5)]
+    db.session.add_all(posts)
+    db.session.commit()
+    expected = u1.followed_posts().order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', listener)
+    with self.app.test_request_context():
+      query, keys = u1.timeline_with_keys()
+      first = keyset_paginate(query, keys, None, 3, ('timestamp', 'id'))
+      second = keyset_paginate(query, keys, first.next_args['cursor'], 3, ('timestamp', 'id'))
+    db.event.remove(db.engine, 'before_cursor_execute', listener)
+    self.assertEqual(first.items + second.items, expected)
+    # seeks and sorts on the timeline's own columns, so its (user_id, timestamp) index is used
+    self.assertIn('ORDER BY timeline.timestamp DESC, timeline.post_id DESC', statements[-1])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
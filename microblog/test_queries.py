@@ -0,0 +1,321 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from app import create_app, db, last_seen, identity
+from app.models import User, Post, Message
+from test_user import TestConfig
+
+class QueryCountConfig(TestConfig):
+  POSTS_PER_PAGE = 50
+  LAST_SEEN_FLUSH_INTERVAL = 3600
+
+class QueryCountCase(unittest.TestCase):
+  """List pages must issue a constant number of statements, however many rows they show"""
+
+  def setUp(self):
+    self.app = create_app(QueryCountConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    self.user = User(username='reader', email='reader@example.com')
+    db.session.add(self.user)
+    db.session.commit()
+    self.client = self.app.test_client()
+    with self.client.session_transaction() as session:
+      session['user_id'] = str(self.user.id)
+
+  def tearDown(self):
+    last_seen.close()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def add_rows(self, n):
+    # every row by a different author, the worst case for lazy loading
+    reader = User.query.filter_by(username='reader').first()
+    start = User.query.count()
+    authors = [User(username='author{}'.format(i), email='author{}@example.com'.format(i)) for i in range(start, start + n)]
+    db.session.add_all(authors)
+    db.session.commit()
+    for author in authors:
+      reader.follow(author)
+      db.session.add_all([Post(body='post', author=author), Message(body='message', author=author, recipient=reader)])
+    db.session.commit()
+
+  def statements(self, url):
+    # start from an empty identity map, as a real request would
+    db.session.remove()
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+      response = self.client.get(url)
+    finally:
+      db.event.remove(db.engine, 'before_cursor_execute', listener)
+    self.assertEqual(response.status_code, 200)
+    return statements
+
+  def count_queries(self, url):
+    return len(self.statements(url))
+
+  def test_feed_pages_run_constant_queries(self):
+    urls = ['/index', '/explore', '/messages', '/user/author1']
+    self.add_rows(2)
+    few = {url: self.count_queries(url) for url in urls}
+    self.add_rows(50)
+    many = {url: self.count_queries(url) for url in urls}
+    self.assertEqual(few, many)
+    for url, count in many.items():
+      self.assertLessEqual(count, 8, url)
+
+  def test_identity_cache(self):
+    user_statements = lambda: len([s for s in self.statements('/index') if 'FROM user' in s and 'user.id = ?' in s])
+    self.assertEqual(user_statements(), 1)
+    self.assertEqual(user_statements(), 0)
+    self.assertEqual((identity.stats()['hits'], identity.stats()['misses']), (1, 1))
+
+    # columns outside the snapshot are loaded on demand
+    reader = User.query.filter_by(username='reader').first()
+    reader.about_me = 'cached or not'
+    db.session.commit()
+    db.session.remove()
+    self.assertIn(b'cached or not', self.client.get('/edit_profile').data)
+    # the commit dropped the stale snapshot
+    self.assertEqual(identity.stats()['misses'], 2)
+    self.assertEqual(user_statements(), 0)
+
+  def test_conditional_get_and_page_cache(self):
+    self.add_rows(3)
+    first = self.client.get('/user/author1')
+    etag = first.headers['ETag']
+    self.assertIsNotNone(first.last_modified)
+    self.assertEqual(self.client.get('/user/author1', headers={'If-None-Match': etag}).status_code, 304)
+
+    # served from the page cache: only the viewer and version lookups run
+    hit = self.statements('/user/author1')
+    self.assertLess(len(hit), self.count_queries('/user/author2'))
+    self.assertEqual(self.app.extensions['page_cache'].stats()['hits'], 1)
+
+    # following changes the page, and the commit empties the cache
+    reader = User.query.filter_by(username='reader').first()
+    reader.unfollow(User.query.filter_by(username='author1').first())
+    db.session.commit()
+    self.assertEqual(len(self.app.extensions['page_cache']), 0)
+    changed = self.client.get('/user/author1', headers={'If-None-Match': etag})
+    self.assertEqual(changed.status_code, 200)
+    self.assertIn(b'Follow', changed.data)
+
+    # a renamed author changes the explore page without a new post
+    etag = self.client.get('/explore').headers['ETag']
+    author = User.query.filter_by(username='author2').first()
+    author.username = 'renamed'
+    db.session.commit()
+    changed = self.client.get('/explore', headers={'If-None-Match': etag})
+    self.assertEqual(changed.status_code, 200)
+    self.assertIn(b'renamed', changed.data)
+    self.assertIsNotNone(author.profile_changed)
+    # a matching ETag costs index lookups, not the page's own query
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', listener)
+    again = self.client.get('/explore', headers={'If-None-Match': changed.headers['ETag']})
+    db.event.remove(db.engine, 'before_cursor_execute', listener)
+    self.assertEqual(again.status_code, 304)
+    self.assertFalse([statement for statement in statements if 'JOIN' in statement])
+    # If-Modified-Since alone is not enough for a 304
+    stale = self.client.get('/explore', headers={'If-Modified-Since': changed.headers['Last-Modified']})
+    self.assertEqual(stale.status_code, 200)
+
+  def test_post_fragment_cache(self):
+    self.add_rows(3)
+    stats = self.app.extensions['fragment_cache'].stats
+    self.client.get('/index')
+    self.assertEqual(stats()['entries'], 3)
+    self.client.get('/explore')
+    self.assertEqual(stats()['hits'], 3)
+
+    # a renamed author invalidates their posts, an edited post its own entry
+    author = User.query.filter_by(username='author1').first()
+    author.username = 'renamed'
+    Post.query.filter_by(user_id=User.query.filter_by(username='author2').first().id).one().body = 'edited'
+    db.session.commit()
+    page = self.client.get('/index').data
+    self.assertIn(b'renamed', page)
+    self.assertIn(b'edited', page)
+    # the edited post was dropped on flush, the renamed author's is replaced on read
+    self.assertEqual(stats()['misses'], 4)
+    self.assertEqual(stats()['entries'], 3)
+
+  def test_user_cards(self):
+    self.add_rows(3)
+    url = '/users/cards?u=author1&u=author2&u=reader&u=nobody'
+    cards = self.client.get(url).get_json()
+    self.assertEqual(sorted(cards), ['author1', 'author2', 'reader'])
+    self.assertEqual(cards['author1']['followers'], 1)
+    self.assertEqual([cards[u]['is_following'] for u in ('author1', 'reader')], [True, None])
+
+    # cached cards and the cached follow graph: nothing beyond loading the viewer
+    known = '/users/cards?u=author1&u=author2&u=reader'
+    self.statements(known)
+    self.assertEqual(self.count_queries(known), self.count_queries('/users/cards'))
+    response = self.client.get(url)
+    self.assertTrue(response.cache_control.no_cache)
+    self.assertEqual(self.client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+    reader = User.query.filter_by(username='reader').first()
+    reader.unfollow(User.query.filter_by(username='author1').first())
+    db.session.commit()
+    card = self.client.get(url).get_json()['author1']
+    self.assertEqual((card['followers'], card['is_following']), (0, False))
+    self.app.config['CARDS_MAX_BATCH'] = 2
+    self.assertEqual(self.client.get(url).status_code, 400)
+
+  def test_account_export(self):
+    import gzip, json
+    self.add_rows(3)
+    reader = User.query.filter_by(username='reader').first()
+    db.session.add(Post(body='mine', author=reader))
+    User.query.filter_by(username='author2').first().follow(reader)
+    db.session.commit()
+    response = self.client.get('/export')
+    self.assertEqual(response.mimetype, 'application/x-ndjson')
+    lines = response.get_data(as_text=True).splitlines()
+    records = [json.loads(line) for line in lines]
+    self.assertEqual([r['type'] for r in records], ['profile', 'post'] + ['message_received'] * 3 +
+      ['following'] * 3 + ['follower'])
+    self.assertEqual((records[0]['username'], records[1]['body']), ('reader', 'mine'))
+    self.assertEqual([r['sender'] for r in records[2:5]], ['author1', 'author2', 'author3'])
+    self.assertEqual(records[-1]['username'], 'author2')
+
+    # resuming after any line carries on with the line after it
+    for i in (0, 3, 6):
+      resumed = self.client.get('/export?cursor=' + records[i]['cursor']).get_data(as_text=True)
+      self.assertEqual(resumed.splitlines(), lines[i + 1:])
+    self.assertEqual(self.client.get('/export?cursor=' + records[-1]['cursor']).get_data(), b'')
+    self.assertEqual(self.client.get('/export?cursor=nonsense').status_code, 400)
+
+    response = self.client.get('/export', headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+    # last_seen moves on between requests
+    self.assertEqual(gzip.decompress(response.get_data()).decode('utf-8').splitlines()[1:], lines[1:])
+
+  def test_hot_queries_use_indexes(self):
+    from app.audit import known_queries, explain, scans
+    self.add_rows(3)
+    reader = User.query.filter_by(username='reader').first()
+    for name, query in known_queries(reader):
+      found = scans(explain(query))
+      self.assertNotIn('full scan', [kind for kind, table in found], name)
+
+    # MySQL rows as explain() renders them
+    mysql = [
+      'id=1 select_type=SIMPLE table=post partitions=None type=ALL possible_keys=None key=None rows=9 Extra=Using filesort',
+      'id=1 select_type=SIMPLE table=user partitions=None type=index possible_keys=None key=ix_user_email rows=3 Extra=Using index',
+      'id=1 select_type=SIMPLE table=message partitions=None type=ref possible_keys=ix_message_recipient_id '
+      'key=ix_message_recipient_id rows=1 Extra=None',
+    ]
+    self.assertEqual(scans(mysql), [('full scan', 'post'), ('index scan', 'user')])
+
+class ProfileConfig(TestConfig):
+  PROFILE_REQUESTS = True
+  PROFILE_SLOW_REQUEST_MS = 0.001
+
+class ProfilingCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(ProfileConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+
+  def tearDown(self):
+    last_seen.close()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_server_timing(self):
+    u = User(username='susan', email='susan@example.com')
+    db.session.add(u)
+    db.session.commit()
+    client = self.app.test_client()
+    with client.session_transaction() as session:
+      session['user_id'] = str(u.id)
+    with self.assertLogs(self.app.logger, 'INFO') as logs:
+      response = client.get('/user/susan/popup')
+    self.assertEqual(response.status_code, 200)
+    metrics = [m.strip() for m in response.headers['Server-Timing'].split(',')]
+    self.assertEqual([m.split(';')[0] for m in metrics], ['sql', 'render', 'before-request', 'total'])
+    self.assertRegex(metrics[0], r'^sql;desc="[1-9]\d* statements";dur=[\d.]+$')
+    self.assertIn('"endpoint": "main.user_popup"', logs.output[0])
+    # everything is slow under the threshold, so the statements are logged
+    self.assertIn('slow request GET /user/susan/popup', logs.output[1])
+    self.assertIn('FROM user', logs.output[1])
+
+class ReplicaConfig(TestConfig):
+  REPLICA_STICKY_SECONDS = 60
+  WTF_CSRF_ENABLED = False
+
+class ReplicaRoutingCase(unittest.TestCase):
+  """GET requests read from a copy of the database file, made before susan signed up"""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    primary, replica = os.path.join(self.dir, 'primary.db'), os.path.join(self.dir, 'replica.db')
+    ReplicaConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+    ReplicaConfig.SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+    self.app = create_app(ReplicaConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    self.reader = User(username='reader', email='reader@example.com')
+    db.session.add(self.reader)
+    db.session.commit()
+    # the backup API, as a plain copy would miss what is still in the WAL file
+    source, target = sqlite3.connect(primary), sqlite3.connect(replica)
+    source.backup(target)
+    source.close()
+    target.close()
+    db.session.add(User(username='susan', email='susan@example.com'))
+    db.session.commit()
+    self.client = self.app.test_client()
+    with self.client.session_transaction() as session:
+      session['user_id'] = str(self.reader.id)
+
+  def tearDown(self):
+    last_seen.close()
+    db.session.remove()
+    db.get_engine(self.app).dispose()
+    db.get_engine(self.app, 'replica_0').dispose()
+    self.app_context.pop()
+    shutil.rmtree(self.dir)
+
+  def get(self, url):
+    db.session.remove()
+    return self.client.get(url)
+
+  def test_reads_go_to_the_replica_until_a_write(self):
+    self.assertEqual(self.get('/user/susan').status_code, 404)
+    self.assertEqual(User.query.filter_by(username='susan').count(), 1)
+    # writing makes the reader stick to the primary for a while
+    self.assertEqual(self.client.post('/edit_profile', data={'username': 'reader', 'about_me': 'hello'}).status_code, 302)
+    self.assertEqual(self.get('/user/susan').status_code, 200)
+    with self.client.session_transaction() as session:
+      session.pop('_db_primary_until')
+    self.assertEqual(self.get('/user/susan').status_code, 404)
+
+  def test_cache_fills_and_writes_read_the_primary(self):
+    from app.models import followers
+    # the cards outlive the request, so they are never filled from the replica
+    self.assertEqual(list(self.get('/users/cards?u=susan').get_json()), ['susan'])
+    self.assertEqual(self.get('/follow/susan').status_code, 302)
+    susan = User.query.filter_by(username='susan').one()
+    self.assertEqual(db.session.query(followers).all(), [(self.reader.id, susan.id)])
+    with self.client.session_transaction() as session:
+      session.pop('_db_primary_until')
+    self.get('/follow/susan')
+    self.assertEqual(db.session.query(followers).count(), 1)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,183 @@
+import json
+import os
+import tempfile
+import unittest
+from app import create_app, db, indexer
+from app.models import User, Post
+from app.search import ElasticsearchBackend, SQLiteBackend
+from test_user import TestConfig
+
+class FakeElasticsearch(object):
+  """Just enough of the Elasticsearch client for the indexing pipeline"""
+
+  def __init__(self, failures=0, rejected=()):
+    self.docs = {}
+    self.bulk_calls = 0
+    self.failures = failures
+    self.rejected = set(rejected)
+
+  def bulk(self, body):
+    self.bulk_calls += 1
+    if self.failures:
+      self.failures -= 1
+      raise ConnectionError('cluster unreachable')
+    items, lines = [], iter(body)
+    for line in lines:
+      op, meta = next(iter(line.items()))
+      key = (meta['_index'], meta['_id'])
+      if op == 'index':
+        doc = next(lines)
+        if meta['_id'] in self.rejected:
+          items.append({op: {'_id': meta['_id'], 'status': 400, 'error': 'mapper_parsing_exception'}})
+          continue
+        self.docs[key] = doc
+        items.append({op: {'_id': meta['_id'], 'status': 201}})
+      else:
+        found = self.docs.pop(key, None)
+        items.append({op: {'_id': meta['_id'], 'status': 200 if found else 404}})
+    return {'errors': any(item[op]['status'] >= 300 for item in items for op in item), 'items': items}
+
+  def search(self, index, doc_type, body):
+    query = body['query']['multi_match']['query']
+    ids = sorted(id for (i, id), doc in self.docs.items() if i == index and query in doc['body'])
+    hits = ids[body['from']:body['from'] + body['size']]
+    return {'hits': {'total': {'value': len(ids), 'relation': 'eq'}, 'hits': [{'_id': str(id)} for id in hits]}}
+
+class SearchConfig(TestConfig):
+  SEARCH_RETRY_BACKOFF = 0
+  SEARCH_MAX_RETRIES = 2
+
+class SearchIndexerCase(unittest.TestCase):
+  def setUp(self):
+    self.deadletter = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False).name
+    self.app = create_app(SearchConfig)
+    self.app.config['SEARCH_DEADLETTER_LOG'] = self.deadletter
+    self.app.search_backend = ElasticsearchBackend(FakeElasticsearch())
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    self.user = User(username='john', email='john@example.com')
+    db.session.add(self.user)
+    db.session.commit()
+
+  def tearDown(self):
+    indexer.close()
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+    os.remove(self.deadletter)
+
+  def test_bulk_index_after_commit(self):
+    es = self.app.search_backend.client
+    posts = [Post(body='hello {}'.format(i), author=self.user) for i in range(3)]
+    db.session.add_all(posts)
+    db.session.flush()
+    db.session.rollback()
+    db.session.add_all([Post(body='hello {}'.format(i), author=self.user) for i in range(3)])
+    db.session.commit()
+    indexer.join()
+    # the rolled back posts never reach the index, the committed ones arrive in one request
+    self.assertEqual(es.bulk_calls, 1)
+    self.assertEqual(sorted(doc['body'] for doc in es.docs.values()), ['hello 0', 'hello 1', 'hello 2'])
+    query, total = Post.search('hello', 1, 2)
+    self.assertEqual(total, 3)
+    self.assertEqual(len(query.all()), 2)
+
+    db.session.delete(Post.query.first())
+    db.session.commit()
+    indexer.join()
+    self.assertEqual(len(es.docs), 2)
+
+    # closing sends what is still queued and stops the worker
+    thread = self.app.extensions['search_indexer'].thread
+    db.session.delete(Post.query.first())
+    db.session.commit()
+    indexer.close()
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(len(es.docs), 1)
+
+  def test_retry_and_dead_letter(self):
+    es = FakeElasticsearch(failures=1)
+    self.app.search_backend = ElasticsearchBackend(es)
+    p = Post(body='retried', author=self.user)
+    db.session.add(p)
+    db.session.commit()
+    indexer.join()
+    self.assertEqual(es.bulk_calls, 2)
+    self.assertEqual(len(es.docs), 1)
+
+    es.rejected.add(p.id + 1)
+    db.session.add(Post(body='rejected', author=self.user))
+    db.session.commit()
+    indexer.join()
+    with open(self.deadletter) as f:
+      letters = [json.loads(line) for line in f]
+    self.assertEqual([(l['action']['body']['body'], l['status']) for l in letters], [('rejected', 400)])
+
+    # a cluster that stays down is dead-lettered after SEARCH_MAX_RETRIES
+    es.failures = 10
+    db.session.add(Post(body='unreachable', author=self.user))
+    db.session.commit()
+    indexer.join()
+    with open(self.deadletter) as f:
+      self.assertEqual(len(f.readlines()), 2)
+
+  def test_reindex_resumes_from_checkpoint(self):
+    db.session.execute(Post.__table__.insert(), [{'body': 'post {}'.format(i), 'user_id': self.user.id} for i in range(10)])
+    db.session.commit()
+    es = self.app.search_backend.client
+    checkpoint = self.deadletter + '.checkpoint'
+    with open(checkpoint, 'w') as f:
+      json.dump({'index': 'post', 'last_id': 6}, f)
+    reports = []
+    stats = Post.reindex(chunk_size=3, workers=2, checkpoint=checkpoint, report=lambda s: reports.append(s['last_id']))
+    self.assertEqual(sorted(id for index, id in es.docs), [7, 8, 9, 10])
+    self.assertEqual((stats['resumed_from'], stats['indexed'], stats['failed']), (6, 4, 0))
+    self.assertEqual(reports, [9, 10])
+    self.assertFalse(os.path.exists(checkpoint))
+
+    stats = Post.reindex(chunk_size=3, workers=2, checkpoint=checkpoint)
+    self.assertEqual(stats['indexed'], 10)
+    self.assertEqual(len(es.docs), 10)
+
+class SQLiteBackendCase(unittest.TestCase):
+  def setUp(self):
+    self.app = create_app(TestConfig)
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    self.app_context.pop()
+
+  def test_embedded_engine_is_default(self):
+    self.assertIsInstance(self.app.search_backend, SQLiteBackend)
+
+  def test_ranked_search(self):
+    u = User(username='john', email='john@example.com')
+    db.session.add_all([
+      Post(body='the cat sat on the mat', author=u),
+      Post(body='dogs and more dogs', author=u),
+      Post(body='cat and dog, dog and cat', author=u),
+      Post(body='nothing to see here', author=u),
+    ])
+    db.session.commit()
+    indexer.join()
+
+    # every post mentioning a term (or its stem) matches, the denser match first
+    query, total = Post.search('cat dog', 1, 10)
+    self.assertEqual(total, 3)
+    self.assertEqual([p.body for p in query][0], 'cat and dog, dog and cat')
+    query, total = Post.search('mat', 1, 1)
+    self.assertEqual((total, [p.body for p in query]), (1, ['the cat sat on the mat']))
+    self.assertEqual(Post.search('"); drop', 1, 10)[1], 0)
+
+    db.session.delete(Post.query.filter_by(body='the cat sat on the mat').first())
+    db.session.commit()
+    indexer.join()
+    self.assertEqual(Post.search('mat', 1, 10)[1], 0)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
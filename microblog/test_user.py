@@ -1,12 +1,15 @@
 from datetime import datetime, timedelta
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from app import create_app, db, last_seen, follow_graph, hasher
+from app.hashing import HashingBusy
+from app.models import User, Post, Message, followers
 from config import Config
 
 class TestConfig(Config):
   TESTING = True
   SQLALCHEMY_DATABASE_URI = 'sqlite://'
+  SEARCH_SQLITE_PATH = ':memory:'
+  PASSWORD_HASH_WORKERS = 0
 
 class UserModelCase(unittest.TestCase):
   # special method of unittest
@@ -28,6 +31,32 @@ class UserModelCase(unittest.TestCase):
     self.assertFalse(u.check_password('dog'))
     self.assertTrue(u.check_password('cat'))
 
+  def test_password_rehash(self):
+    u = User(username='susan')
+    u.set_password('cat')
+    self.assertFalse(u.password_needs_rehash())
+    self.app.config['PASSWORD_HASH_ITERATIONS'] = 200000
+    self.assertTrue(u.password_needs_rehash())
+    self.assertTrue(u.check_password('cat'))
+    u.set_password('cat')
+    self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:200000$'))
+
+  def test_password_hashing_pool(self):
+    self.app.config['PASSWORD_HASH_WORKERS'] = 1
+    u = User(username='susan')
+    u.set_password('cat')
+    self.assertTrue(u.check_password('cat'))
+    self.assertFalse(u.check_password('dog'))
+    # callers beyond PASSWORD_HASH_MAX_PENDING are turned away
+    state = self.app.extensions['password_hasher']
+    while state.slots.acquire(blocking=False):
+      pass
+    with self.assertRaises(HashingBusy):
+      u.check_password('cat')
+    # closing stops the worker processes
+    hasher.close()
+    self.assertIsNone(state.pool)
+
   def test_avatar(self):
     u = User(username='john', email='john@example.com')
     self.assertEqual(
@@ -92,5 +121,284 @@ class UserModelCase(unittest.TestCase):
     self.assertEqual(f3, [p3, p4])
     self.assertEqual(f4, [p4])
 
+  def test_timeline(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    u3 = User(username='mary', email='mary@example.com')
+    db.session.add_all([u1, u2, u3])
+    db.session.commit()
+
+    now = datetime.utcnow()
+    p1 = Post(body="post from susan", author=u2, timestamp=now + timedelta(seconds=1))
+    db.session.add(p1)
+    db.session.commit()
+
+    # following backfills the posts written before the follow
+    u1.follow(u2)
+    u1.follow(u3)
+    db.session.commit()
+    self.assertEqual(u1.timeline().all(), [p1])
+
+    # new posts are pushed to the author and every follower
+    p2 = Post(body="post from mary", author=u3, timestamp=now + timedelta(seconds=2))
+    p3 = Post(body="post from john", author=u1, timestamp=now + timedelta(seconds=3))
+    db.session.add_all([p2, p3])
+    db.session.commit()
+    self.assertEqual(u1.timeline().all(), [p3, p2, p1])
+    self.assertEqual(u1.timeline().all(), u1.followed_posts().all())
+    self.assertEqual(u3.timeline().all(), [p2])
+
+    # unfollowing trims the unfollowed user's posts
+    u1.unfollow(u2)
+    db.session.commit()
+    self.assertEqual(u1.timeline().all(), [p3, p2])
+
+  def test_timeline_fanout_on_read(self):
+    self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    db.session.commit()
+
+    # susan has more followers than the limit, so her post is read on demand
+    now = datetime.utcnow()
+    p1 = Post(body="post from susan", author=u2, timestamp=now + timedelta(seconds=1))
+    p2 = Post(body="post from john", author=u1, timestamp=now + timedelta(seconds=2))
+    db.session.add_all([p1, p2])
+    db.session.commit()
+    self.assertTrue(u2.fanout_on_read)
+    self.assertEqual(u1.timeline().all(), [p2, p1])
+    self.assertEqual(u2.timeline().all(), [p1])
+
+  def test_counters(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    u3 = User(username='mary', email='mary@example.com')
+    db.session.add_all([u1, u2, u3, Post(body='hi', author=u2)])
+    db.session.commit()
+    self.assertEqual(u2.posts_count, 1)
+
+    u1.follow(u2)
+    u1.follow(u3)
+    u3.follow(u2)
+    db.session.add_all([Post(body='one', author=u2), Post(body='two', author=u2)])
+    db.session.commit()
+    counts = lambda u: (u.followers_count, u.followed_count, u.posts_count)
+    self.assertEqual([counts(u) for u in (u1, u2, u3)], [(0, 2, 0), (2, 0, 3), (1, 1, 0)])
+
+    u1.unfollow(u2)
+    db.session.delete(u2.posts.first())
+    db.session.commit()
+    self.assertEqual([counts(u) for u in (u1, u2, u3)], [(0, 1, 0), (1, 0, 2), (1, 1, 0)])
+
+    # counts queued in a rolled back transaction are forgotten with it
+    u2.follow(u1)
+    db.session.rollback()
+    db.session.add(Post(body='three', author=u3))
+    db.session.commit()
+    self.assertEqual([counts(u) for u in (u1, u2, u3)], [(0, 1, 0), (1, 0, 2), (1, 1, 1)])
+
+    # drift introduced behind the ORM's back is found and repaired
+    db.session.execute(User.__table__.update().where(User.id == u2.id).values(followers_count=7))
+    db.session.commit()
+    # limited to the users above `after`
+    self.assertEqual(User.reconcile_counters(after=u2.id), [])
+    self.assertEqual(User.reconcile_counters(), [u2.id])
+    db.session.commit()
+    self.assertEqual(counts(u2), (1, 0, 2))
+    self.assertEqual(User.reconcile_counters(), [])
+
+  def test_unread_messages_counter(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    db.session.add_all([u1, u2, Message(body='hi', author=u1, recipient=u2)])
+    db.session.commit()
+    db.session.add_all([Message(body='one', author=u1, recipient=u2), Message(body='two', author=u1, recipient=u2)])
+    db.session.commit()
+    self.assertEqual((u1.new_messages(), u2.new_messages()), (0, 3))
+
+    u2.read_messages()
+    db.session.commit()
+    self.assertEqual(u2.new_messages(), 0)
+    db.session.add(Message(body='three', author=u1, recipient=u2))
+    db.session.commit()
+    self.assertEqual(u2.new_messages(), 1)
+
+    db.session.execute(User.__table__.update().where(User.id == u2.id).values(unread_messages_count=5))
+    db.session.commit()
+    self.assertEqual(User.reconcile_counters(), [u2.id])
+    db.session.commit()
+    self.assertEqual(u2.new_messages(), 1)
+
+  def test_follow_graph_cache(self):
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    u3 = User(username='mary', email='mary@example.com')
+    db.session.add_all([u1, u2, u3])
+    db.session.commit()
+    u1.follow(u2)
+    db.session.commit()
+    # reload the expired users so only follow graph queries are counted
+    [u.id for u in (u1, u2, u3)]
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', listener)
+    self.assertTrue(u1.is_following(u2))
+    self.assertFalse(u1.is_following(u3))
+    self.assertEqual(len(statements), 1)
+
+    # writes to followers outside the ORM invalidate the cached set as well
+    db.session.execute(followers.insert().values(follower_id=u1.id, followed_id=u3.id))
+    db.session.commit()
+    db.event.remove(db.engine, 'before_cursor_execute', listener)
+    self.assertTrue(u1.is_following(u3))
+    self.assertEqual(u1.followed_posts().all(), [])
+
+    # a rolled back follow does not linger in the cache
+    u2.follow(u3)
+    self.assertTrue(u2.is_following(u3))
+    db.session.rollback()
+    self.assertFalse(u2.is_following(u3))
+
+    # bounded by the total number of ids held
+    cache = self.app.extensions['follow_graph']
+    cache.capacity = 3
+    follow_graph.followed_ids(u2.id)
+    follow_graph.followed_ids(u3.id)
+    self.assertEqual(cache.stats()['entries'], 2)
+    self.assertGreater(cache.stats()['evictions'], 0)
+
+    # follows made by other processes are picked up once an entry expires
+    from array import array
+    self.assertEqual(cache.ttl, self.app.config['FOLLOW_GRAPH_CACHE_TTL'])
+    cache.capacity, cache.ttl = 1000, 0
+    cache.set(u1.id, array('q'))
+    self.assertTrue(u1.is_following(u2))
+
+    # follow and unfollow go by the database even when the cache is stale
+    cache.ttl = 3600
+    cache.set(u1.id, array('q'))
+    self.assertFalse(u1.is_following(u2))
+    self.assertFalse(u1.follow(u2))
+    db.session.commit()
+    self.assertEqual(u1.followed.count(), 2)
+    cache.set(u1.id, array('q', [u2.id, u3.id]))
+    self.assertTrue(u2.unfollow(u3) is False)
+    self.assertTrue(u1.unfollow(u2))
+    db.session.commit()
+    self.assertFalse(u1.is_following(u2))
+    self.assertEqual(u1.followed.all(), [u3])
+
+  def test_last_seen_write_behind(self):
+    self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+    u1 = User(username='john', email='john@example.com')
+    u2 = User(username='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    seen = datetime(2030, 1, 1)
+    last_seen.touch(u1, seen)
+    last_seen.touch(u2, seen)
+    last_seen.touch(u1, seen + timedelta(minutes=1))
+
+    # the loaded instance is current but nothing has been written yet
+    self.assertEqual(u1.last_seen, seen + timedelta(minutes=1))
+    self.assertNotIn(u1, db.session.dirty)
+    stored = lambda: dict(db.session.query(User.username, User.last_seen).all())
+    self.assertNotEqual(stored()['john'], seen + timedelta(minutes=1))
+
+    db.session.rollback()
+    self.assertEqual(last_seen.flush(), 2)
+    self.assertEqual(stored(), {'john': seen + timedelta(minutes=1), 'susan': seen})
+
+    # closing the buffer writes what is left and stops its flusher thread
+    thread = self.app.extensions['last_seen'].thread
+    self.assertTrue(thread.is_alive())
+    last_seen.touch(u2, seen + timedelta(minutes=2))
+    last_seen.close()
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(stored()['susan'], seen + timedelta(minutes=2))
+
+  def test_synthetic_dataset(self):
+    from app.synthetic import generate
+    self.app.config['TIMELINE_FANOUT_LIMIT'] = 5
+    counts = generate(users=30, posts=200, messages=50, follows=4, seed=1)
+    self.assertEqual(counts['users'], 30)
+    self.assertEqual(Post.query.count(), 200)
+
+    # the derived state is what the ORM would have kept up to date
+    self.assertEqual(User.reconcile_counters(), [])
+    for u in User.query.all():
+      self.assertEqual(u.fanout_on_read, u.followers_count > 5)
+      self.assertEqual(u.timeline().all(), u.followed_posts().all())
+
+  def test_bulk_import(self):
+    import json, os, tempfile
+    from unittest import mock
+    from app.importer import Importer, BadRecord
+    # already signed up: the file's ann is someone else, and gets nothing of theirs
+    ann = User(username='ann', email='ann@example.com')
+    db.session.add(ann)
+    db.session.commit()
+    directory = tempfile.mkdtemp()
+    def write(name, lines):
+      path = os.path.join(directory, name)
+      with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+      return path
+    users = write('users.csv', ['username,email,password,about_me',
+      'john,john@example.com,cat,', 'susan,susan@example.com,dog,hi', 'mary,mary@example.com,,',
+      'john,other@example.com,cat,', 'ann,ann@elsewhere.com,pig,'])
+    follows = write('follows.jsonl', [json.dumps({'follower': a, 'followed': b}) for a, b in
+      (('john', 'susan'), ('susan', 'john'), ('john', 'john'), ('mary', 'nobody'), ('mary', 'john'),
+       ('ann', 'john'))])
+    messages = write('messages.jsonl', [json.dumps({'sender': a, 'recipient': 'john', 'body': 'hi'}) for a in ('ann', 'mary')])
+    posts = write('posts.jsonl', [json.dumps({'username': 'john', 'body': 'post {}'.format(i),
+      'timestamp': '2020-01-01T00:00:{:02d}Z'.format(i)}) for i in range(5)] + ['{broken'])
+    files = {'users': users, 'follows': follows, 'posts': posts, 'messages': messages}
+    checkpoint = os.path.join(directory, 'import.json')
+    importer = Importer(checkpoint, batch_size=2, hash_workers=0, hash_iterations=1000)
+    with self.assertRaisesRegex(BadRecord, r'posts\.jsonl:6: '):
+      importer.run(files)
+    self.assertEqual(Post.query.count(), 4)
+
+    # the last batch committed but its checkpoint did not: it is replayed
+    with open(checkpoint) as f:
+      state = json.load(f)
+    self.assertEqual(state['files']['posts'], dict(state['files']['posts'], done=4, pending=4))
+    state['files']['posts'].update(done=2, pending=4)
+    with open(checkpoint, 'w') as f:
+      json.dump(state, f)
+    with open(posts, 'w') as f:
+      f.write(''.join(json.dumps({'username': 'john', 'body': 'post {}'.format(i),
+        'timestamp': '2020-01-01T00:00:{:02d}Z'.format(i)}) + '\n' for i in range(6)))
+    state = Importer(checkpoint, batch_size=2, hash_workers=0).run(files)
+    self.assertFalse(os.path.exists(checkpoint))
+    self.assertEqual(state['taken'], ['ann'])
+    self.assertEqual([state['files'][kind]['skipped'] for kind in ('users', 'follows', 'messages')], [2, 3, 1])
+    self.assertEqual((ann.followed.count(), ann.messages_sent.count()), (0, 0))
+
+    john, susan, mary = [User.query.filter_by(username=name).one() for name in ('john', 'susan', 'mary')]
+    self.assertEqual(sorted(p.body for p in john.posts), ['post {}'.format(i) for i in range(6)])
+    self.assertTrue(john.check_password('cat'))
+    self.assertTrue(susan.password_needs_rehash())
+    self.assertIsNone(mary.password_hash)
+    self.assertEqual(susan.about_me, 'hi')
+    self.assertEqual(john.followers.count(), 2)
+    self.assertEqual(User.reconcile_counters(), [])
+    self.assertEqual(susan.timeline().all(), susan.followed_posts().all())
+    self.assertEqual(Post.search('post', 1, 10)[1], 6)
+
+    # where the database cannot skip taken rows itself, they are left out beforehand
+    again = write('again.csv', ['username,email', 'mary,new@example.com', 'rose,mary@example.com',
+      'lily,lily@example.com', 'lily,lily2@example.com'])
+    with mock.patch('app.importer.insert_ignoring', return_value=None):
+      state = Importer(checkpoint, hash_workers=0).run({'users': again}, reindex=False)
+    self.assertEqual(state['files']['users']['skipped'], 3)
+    self.assertEqual(state['taken'], ['mary'])
+    self.assertEqual(User.query.filter_by(username='lily').one().email, 'lily@example.com')
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file